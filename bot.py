@@ -1,12 +1,28 @@
+import atexit
+import io
+import itertools
 import json
 import logging
 import os
+import re
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from uuid import uuid4
 from dotenv import load_dotenv
 import gnupg
+try:
+    from orjson import dumps as _orjson_dumps, loads as _loads
+except ImportError:  # optional speedup, fall back to the stdlib parser
+    _orjson_dumps = None
+    _loads = json.loads
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
+from telegram.error import RetryAfter
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler, CallbackContext)
 
 load_dotenv()
@@ -15,6 +31,11 @@ if not TOKEN:
     print("Please set TELEGRAM_TOKEN in environment or .env file")
     exit(1)
 
+# When set (e.g. https://example.com), Telegram pushes updates to a webhook
+# instead of the bot long-polling for them.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+
 DATA_FILE = os.path.join(os.path.dirname(__file__), 'data.json')
 GNUPG_HOME = os.path.join(os.path.dirname(__file__), '.gnupg')
 
@@ -35,31 +56,176 @@ except TypeError:
 # Conversation states
 ASK_SECRET, ASK_COUNTRY, MAIN_MENU, CHECKOUT_ADDR, CHECKOUT_NOTES, CHECKOUT_PAYTYPE = range(6)
 
+# Reply keyboards never change, so build them once
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup([
+    ['About', 'Products'],
+    ['Cart', 'Checkout'],
+    ['Order History', 'Support']
+], resize_keyboard=True)
+COUNTRY_MARKUP = ReplyKeyboardMarkup([[c] for c in ('USA', 'UK', 'Nigeria', 'India', 'Other')], one_time_keyboard=True, resize_keyboard=True)
+PAY_MARKUP = ReplyKeyboardMarkup([['BTC', 'USDT']], one_time_keyboard=True, resize_keyboard=True)
+
+# callback_data patterns for the inline keyboards
+CAT_RE = re.compile(r'^cat\|')
+ADD_RE = re.compile(r'^add\|')
+BACKCATS_RE = re.compile(r'^backcats$')
+
 # Helper JSON functions
 
+# Parsed contents of DATA_FILE, keyed on the stat that produced them so
+# handlers only re-parse the file after it changes on disk.
+_CACHE = {'mtime': None, 'size': None, 'data': None}
+
+# Changes announced with mark_dirty() are written out after this many seconds,
+# so a burst of updates costs a single save.
+SAVE_DELAY = 0.25
+_DIRTY = False
+_SAVE_TIMER = None
+# Every write to DATA_FILE runs on this single thread, so writes never overlap
+_WRITER = ThreadPoolExecutor(max_workers=1)
+# Held by handlers around load -> mutate sequences and while the data is
+# serialized, so a save never captures a half-applied change. Do not call
+# save_data() while holding it: the writer thread needs it too.
+_DATA_LOCK = threading.RLock()
+
+# Lookup tables derived from the cached data, rebuilt whenever it is re-parsed.
+_TID_INDEX = {}  # telegram_id -> secret
+_PID_INDEX = {}  # product id -> product
+_OID_INDEX = {}  # order id -> order
+_CATEGORY_RENDER = {}  # category -> (text, markup) shown by category_callback
+# Source of the suffix of new order ids, continuing after the highest one on file
+_ORDER_SEQ = itertools.count(1)
+
+
+def _next_order_seq(orders):
+    seq = 0
+    for o in orders:
+        try:
+            seq = max(seq, int(o['order_id'].rsplit('-', 1)[1], 16))
+        except (IndexError, ValueError):
+            pass
+    return seq + 1
+
+
+def _index(data):
+    global _ORDER_SEQ
+    _TID_INDEX.clear()
+    _TID_INDEX.update((u['telegram_id'], s) for s, u in data.get('users', {}).items() if u.get('telegram_id'))
+    _PID_INDEX.clear()
+    _PID_INDEX.update((p['id'], p) for items in data.get('products', {}).values() for p in items)
+    _OID_INDEX.clear()
+    _OID_INDEX.update((o['order_id'], o) for o in data.get('orders', []))
+    _CATEGORY_RENDER.clear()
+    _ORDER_SEQ = itertools.count(_next_order_seq(data.get('orders', [])))
+
+
+def _remember(data, st):
+    _CACHE['mtime'] = st.st_mtime_ns
+    _CACHE['size'] = st.st_size
+    _CACHE['data'] = data
+
+
 def load_data():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    if _DIRTY:
+        # unsaved changes in memory win over whatever is on disk
+        return _CACHE['data']
+    st = os.stat(DATA_FILE)
+    if (st.st_mtime_ns, st.st_size) == (_CACHE['mtime'], _CACHE['size']):
+        return _CACHE['data']
+    with _DATA_LOCK:
+        st = os.stat(DATA_FILE)
+        if (st.st_mtime_ns, st.st_size) == (_CACHE['mtime'], _CACHE['size']):
+            return _CACHE['data']
+        with open(DATA_FILE, 'rb') as f:
+            data = _loads(f.read())
+        _index(data)
+        _remember(data, st)
+        return data
+
+
+def _write_data(data):
+    global _DIRTY
+    with _DATA_LOCK:
+        if _orjson_dumps is not None:
+            raw = _orjson_dumps(data)
+        else:
+            raw = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        _DIRTY = False
+        # Write to a temp file and swap it in so a crash never leaves a torn
+        # data.json; the lock file keeps other processes from writing at the same time.
+        tmp = DATA_FILE + '.tmp'
+        with open(DATA_FILE + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, DATA_FILE)
+        _remember(data, os.stat(DATA_FILE))
 
 
 def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
+    """Write data to disk and wait until it has been written."""
+    try:
+        future = _WRITER.submit(_write_data, data)
+    except RuntimeError:
+        # The writer is shut down by the time atexit handlers run; by then
+        # nothing else is writing, so do it here.
+        _write_data(data)
+        return
+    future.result()
+
+
+def flush_data():
+    """Write pending changes from mark_dirty() now."""
+    global _SAVE_TIMER
+    with _DATA_LOCK:
+        _SAVE_TIMER = None
+        if not _DIRTY:
+            return
+    save_data(_CACHE['data'])
+
+
+def mark_dirty():
+    """Schedule a save of the cached data instead of writing it inline."""
+    global _DIRTY, _SAVE_TIMER
+    with _DATA_LOCK:
+        _DIRTY = True
+        if _SAVE_TIMER is None:
+            _SAVE_TIMER = threading.Timer(SAVE_DELAY, flush_data)
+            _SAVE_TIMER.daemon = True
+            _SAVE_TIMER.start()
+
+
+# A pending debounced save is not lost if the process exits without reaching
+# the flush at the end of main()
+atexit.register(flush_data)
 
 
 # PGP helper functions
-def generate_pgp_keys():
+
+# Recipient key for encrypt_address(), resolved on first use
+_PGP_KEY_ID = None
+
+
+def generate_pgp_keys(data=None):
     """Generate a PGP key pair if not exists."""
-    data = load_data()
+    if data is None:
+        data = load_data()
     pgp_config = data.get('pgp_config', {})
     
     if pgp_config.get('key_generated'):
         return pgp_config.get('public_key')
     
     # Generate new key
+    # Curve25519 keys: much faster to generate than RSA-2048, with smaller
+    # keys and ciphertext
     input_data = gpg.gen_key_input(
-        key_type='RSA',
-        key_length=2048,
+        key_type='EDDSA',
+        key_curve='ed25519',
+        subkey_type='ECDH',
+        subkey_curve='cv25519',
         name_email='bot@ecommerce.local',
         name_real='Ecommerce Bot'
     )
@@ -70,34 +236,45 @@ def generate_pgp_keys():
     public_key = gpg.export_keys(key_id)
     
     # Save to data.json
-    data['pgp_config']['key_generated'] = True
-    data['pgp_config']['public_key'] = public_key
-    data['pgp_config']['key_id'] = key_id
+    with _DATA_LOCK:
+        data['pgp_config']['key_generated'] = True
+        data['pgp_config']['public_key'] = public_key
+        data['pgp_config']['key_id'] = key_id
     save_data(data)
     
     return public_key
 
 
-def encrypt_address(address):
-    """Encrypt delivery address with the bot's public key."""
+def _pgp_key_id():
+    """Return the id of the bot's key, generating or importing it on first use."""
+    global _PGP_KEY_ID
+    if _PGP_KEY_ID is not None:
+        return _PGP_KEY_ID
     data = load_data()
-    public_key = data.get('pgp_config', {}).get('public_key')
+    pgp_config = data.get('pgp_config', {})
+    public_key = pgp_config.get('public_key')
     
     if not public_key:
         # Generate keys if not exists
-        public_key = generate_pgp_keys()
+        public_key = generate_pgp_keys(data)
     
-    # Import public key
+    # Import once per process: data.json may name a key this keyring has
+    # never seen (fresh deploy, restored data file)
     import_result = gpg.import_keys(public_key)
-    key_id = import_result.fingerprints[0] if import_result.fingerprints else None
-    
-    if not key_id:
-        # Fallback: try to get from existing keys
-        data = load_data()
-        key_id = data.get('pgp_config', {}).get('key_id')
-    
-    # Encrypt
-    encrypted_data = gpg.encrypt(address, key_id, always_trust=True)
+    key_id = import_result.fingerprints[0] if import_result.fingerprints else pgp_config.get('key_id')
+    _PGP_KEY_ID = key_id
+    return key_id
+
+
+def encrypt_address(address):
+    """Encrypt delivery address with the bot's public key.
+
+    Raises RuntimeError if gpg fails, rather than returning an empty address.
+    """
+    encrypted_data = gpg.encrypt(address, _pgp_key_id(), always_trust=True)
+    if not encrypted_data.ok:
+        logger.error('Address encryption failed: %s', encrypted_data.status)
+        raise RuntimeError('address encryption failed')
     return str(encrypted_data)
 
 
@@ -107,21 +284,76 @@ def decrypt_address(encrypted_address):
     return str(decrypted_data)
 
 
+# Outbound message helpers
+
+# Telegram allows about 30 messages per second per bot; stay a little below it.
+MAX_SENDS_PER_SECOND = 25
+# ...and about one message per second to the same chat, allowing a short
+# burst so a reply followed by a menu is not held back.
+PER_CHAT_INTERVAL = 1.0
+PER_CHAT_BURST = 3
+_SEND_TIMES = deque()
+_CHAT_NEXT_SEND = {}  # chat_id -> time.monotonic() up to which its sends are booked
+_SEND_LOCK = threading.Lock()
+
+
+def _throttle(chat_id=None):
+    if chat_id is not None:
+        # Reserve this chat's next slot under the lock but sleep outside it,
+        # so a busy chat does not hold up sends to other chats.
+        with _SEND_LOCK:
+            now = time.monotonic()
+            booked = max(now, _CHAT_NEXT_SEND.get(chat_id, 0))
+            _CHAT_NEXT_SEND[chat_id] = booked + PER_CHAT_INTERVAL
+        wait = booked - now - (PER_CHAT_BURST - 1) * PER_CHAT_INTERVAL
+        if wait > 0:
+            time.sleep(wait)
+    with _SEND_LOCK:
+        now = time.monotonic()
+        while _SEND_TIMES and now - _SEND_TIMES[0] >= 1:
+            _SEND_TIMES.popleft()
+        if len(_SEND_TIMES) >= MAX_SENDS_PER_SECOND:
+            time.sleep(1 - (now - _SEND_TIMES[0]))
+            _SEND_TIMES.popleft()
+        _SEND_TIMES.append(time.monotonic())
+
+
+def send_with_retry(method, *args, chat=None, **kwargs):
+    """Call a Bot API method, pacing sends and waiting out flood limits.
+
+    Pass the id of the target chat as ``chat`` to also keep to the per-chat limit.
+    """
+    while True:
+        _throttle(chat)
+        try:
+            return method(*args, **kwargs)
+        except RetryAfter as e:
+            logger.warning('Flood limit hit, retrying in %s seconds', e.retry_after)
+            time.sleep(e.retry_after)
+
+
+def safe_reply(update: Update, text, **kwargs):
+    return send_with_retry(update.message.reply_text, text, chat=update.effective_chat.id, **kwargs)
+
+
+def safe_edit(update: Update, text, **kwargs):
+    return send_with_retry(update.callback_query.edit_message_text, text, chat=update.effective_chat.id, **kwargs)
+
+
 # Decorator to ensure user exists
 def ensure_user(func):
     @wraps(func)
     def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
         user = update.effective_user
-        data = load_data()
-        # try to find user by telegram id
-        found = None
-        for secret, u in data.get('users', {}).items():
-            if u.get('telegram_id') == user.id:
-                found = secret
-                break
+        load_data()  # refreshes _TID_INDEX if data.json changed on disk
+        found = _TID_INDEX.get(user.id)
         if not found:
             # Not registered
-            update.message.reply_text("You need to /start and register with a secret phrase first.")
+            text = "You need to /start and register with a secret phrase first."
+            if update.callback_query:
+                update.callback_query.answer(text, show_alert=True)
+            else:
+                safe_reply(update, text)
             return ConversationHandler.END
         context.user_data['secret'] = found
         return func(update, context, *args, **kwargs)
@@ -130,7 +362,7 @@ def ensure_user(func):
 
 # /start handler
 def start(update: Update, context: CallbackContext):
-    update.message.reply_text(
+    safe_reply(update,
         "Welcome! Please send me your secret key phrase (this identifies you).\n" 
         "Pick something unique — this will be used as your account identifier.")
     return ASK_SECRET
@@ -139,26 +371,28 @@ def start(update: Update, context: CallbackContext):
 def ask_country(update: Update, context: CallbackContext):
     secret = update.message.text.strip()
     data = load_data()
-    users = data.setdefault('users', {})
+    with _DATA_LOCK:
+        users = data.setdefault('users', {})
+        registered = secret in users
+        if not registered:
+            users[secret] = {
+                'username': update.effective_user.username or '',
+                'telegram_id': update.effective_user.id,
+                'country': None,
+                'cart': [],
+                'cart_total': 0,
+                'orders': []
+            }
+            _TID_INDEX[update.effective_user.id] = secret
+            mark_dirty()
     
-    if secret in users:
-        update.message.reply_text("This secret phrase is already registered. Welcome back!")
+    if registered:
+        safe_reply(update, "This secret phrase is already registered. Welcome back!")
     else:
-        users[secret] = {
-            'username': update.effective_user.username or '',
-            'telegram_id': update.effective_user.id,
-            'country': None,
-            'cart': [],
-            'orders': []
-        }
-        save_data(data)
-        update.message.reply_text("Secret saved!")
+        safe_reply(update, "Secret saved!")
     
-    # country selection keyboard
-    countries = ['USA', 'UK', 'Nigeria', 'India', 'Other']
-    keyboard = ReplyKeyboardMarkup([[c] for c in countries], one_time_keyboard=True, resize_keyboard=True)
     context.user_data['pending_secret'] = secret
-    update.message.reply_text('Please choose your country:', reply_markup=keyboard)
+    safe_reply(update, 'Please choose your country:', reply_markup=COUNTRY_MARKUP)
     return ASK_COUNTRY
 
 
@@ -166,48 +400,51 @@ def save_country(update: Update, context: CallbackContext):
     country = update.message.text.strip()
     secret = context.user_data.get('pending_secret')
     if not secret:
-        update.message.reply_text('Session expired, please /start again.', reply_markup=ReplyKeyboardRemove())
+        safe_reply(update, 'Session expired, please /start again.', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
     data = load_data()
     users = data.setdefault('users', {})
     user = users.get(secret)
     if not user:
-        update.message.reply_text('User not found. Please /start again.', reply_markup=ReplyKeyboardRemove())
+        safe_reply(update, 'User not found. Please /start again.', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    user['country'] = country
-    user['username'] = update.effective_user.username or user.get('username', '')
-    user['telegram_id'] = update.effective_user.id
-    save_data(data)
+    username = update.effective_user.username or user.get('username', '')
+    telegram_id = update.effective_user.id
+    # Re-picking the same details changes nothing, so there is nothing to save
+    if (user.get('country'), user.get('username'), user.get('telegram_id')) != (country, username, telegram_id):
+        with _DATA_LOCK:
+            user['country'] = country
+            user['username'] = username
+            if _TID_INDEX.get(user.get('telegram_id')) == secret:
+                del _TID_INDEX[user['telegram_id']]
+            user['telegram_id'] = telegram_id
+            _TID_INDEX[telegram_id] = secret
+            mark_dirty()
     context.user_data['secret'] = secret
 
-    update.message.reply_text('Registration complete. Welcome!', reply_markup=ReplyKeyboardRemove())
+    safe_reply(update, 'Registration complete. Welcome!', reply_markup=ReplyKeyboardRemove())
     return show_main_menu(update, context)
 
 
 # Main menu
 def show_main_menu(update: Update, context: CallbackContext):
-    keyboard = [
-        ['About', 'Products'],
-        ['Cart', 'Checkout'],
-        ['Order History', 'Support']
-    ]
     if update.callback_query:
         update.callback_query.answer()
-        update.callback_query.edit_message_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        safe_edit(update, 'Main Menu:', reply_markup=MAIN_MENU_MARKUP)
     else:
-        update.message.reply_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        safe_reply(update, 'Main Menu:', reply_markup=MAIN_MENU_MARKUP)
     return MAIN_MENU
 
 
 @ensure_user
 def about(update: Update, context: CallbackContext):
-    update.message.reply_text('This is a demo ecommerce bot. You can browse products, add to cart, and checkout.')
+    safe_reply(update, 'This is a demo ecommerce bot. You can browse products, add to cart, and checkout.')
     return MAIN_MENU
 
 
 @ensure_user
 def support(update: Update, context: CallbackContext):
-    update.message.reply_text('Support: contact support@example.com or reply here and an agent will reach out.')
+    safe_reply(update, 'Support: contact support@example.com or reply here and an agent will reach out.')
     return MAIN_MENU
 
 
@@ -216,10 +453,10 @@ def list_categories(update: Update, context: CallbackContext):
     data = load_data()
     cats = list(data.get('products', {}).keys())
     if not cats:
-        update.message.reply_text('No product categories available.')
+        safe_reply(update, 'No product categories available.')
         return MAIN_MENU
     buttons = [[InlineKeyboardButton(c, callback_data='cat|{}'.format(c))] for c in cats]
-    update.message.reply_text('Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
+    safe_reply(update, 'Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
     return MAIN_MENU
 
 
@@ -227,22 +464,23 @@ def category_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     _, cat = query.data.split('|', 1)
-    data = load_data()
-    products = data.get('products', {}).get(cat, [])
-    if not products:
-        query.edit_message_text('No products in this category.')
-        return
-    text = "Products in {}:\n".format(cat)
-    buttons = []
-    for p in products:
-        name = p['name']
-        price = p['price']
-        desc = p['description']
-        pid = p['id']
-        text += "\n{} — ${}\n{}\n".format(name, price, desc)
-        buttons.append([InlineKeyboardButton("Add {}".format(name), callback_data='add|{}'.format(pid))])
-    buttons.append([InlineKeyboardButton('Back to categories', callback_data='backcats')])
-    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    data = load_data()  # a changed catalog on disk also clears _CATEGORY_RENDER
+    rendered = _CATEGORY_RENDER.get(cat)
+    if rendered is None:
+        products = data.get('products', {}).get(cat, [])
+        if not products:
+            safe_edit(update, 'No products in this category.')
+            return
+        parts = [f"Products in {cat}:\n"]
+        buttons = []
+        for p in products:
+            name = p['name']
+            parts.append(f"\n{name} — ${p['price']}\n{p['description']}\n")
+            buttons.append([InlineKeyboardButton(f"Add {name}", callback_data=f"add|{p['id']}")])
+        buttons.append([InlineKeyboardButton('Back to categories', callback_data='backcats')])
+        rendered = _CATEGORY_RENDER[cat] = (''.join(parts), InlineKeyboardMarkup(buttons))
+    text, markup = rendered
+    safe_edit(update, text, reply_markup=markup)
 
 
 def backcats_callback(update: Update, context: CallbackContext):
@@ -251,34 +489,23 @@ def backcats_callback(update: Update, context: CallbackContext):
     list_categories(update, context)
 
 
+@ensure_user
 def add_to_cart_callback(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
     _, pid = query.data.split('|', 1)
     data = load_data()
-    product = None
-    for cat, items in data.get('products', {}).items():
-        for p in items:
-            if p['id'] == pid:
-                product = p
-                break
+    product = _PID_INDEX.get(pid)
     if not product:
-        query.edit_message_text('Product not found.')
-        return
-    # find user by telegram id
-    user = update.effective_user
-    secret = None
-    for s, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user.id:
-            secret = s
-            break
-    if not secret:
-        query.edit_message_text('User not registered. Use /start to register.')
+        query.answer()
+        safe_edit(update, 'Product not found.')
         return
+    secret = context.user_data['secret']
     users = data['users']
-    cart = users[secret].setdefault('cart', [])
-    cart.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
-    save_data(data)
+    with _DATA_LOCK:
+        users[secret]['cart_total'] = cart_total(users[secret]) + product['price']
+        cart = users[secret].setdefault('cart', [])
+        cart.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
+        mark_dirty()
     query.answer("Added {} to cart.".format(product['name']), show_alert=True)
 
 
@@ -289,15 +516,13 @@ def view_cart(update: Update, context: CallbackContext):
     user = data['users'].get(secret)
     cart = user.get('cart', [])
     if not cart:
-        update.message.reply_text('Your cart is empty.')
+        safe_reply(update, 'Your cart is empty.')
         return MAIN_MENU
-    text = 'Your cart:\n'
-    total = 0
+    parts = ['Your cart:\n']
     for idx, item in enumerate(cart, 1):
-        text += "{0}. {1} — ${2}\n".format(idx, item['name'], item['price'])
-        total += item['price']
-    text += "\nTotal: ${:.2f}".format(total)
-    update.message.reply_text(text)
+        parts.append(f"{idx}. {item['name']} — ${item['price']}\n")
+    parts.append(f"\nTotal: ${cart_total(user):.2f}")
+    safe_reply(update, ''.join(parts))
     return MAIN_MENU
 
 
@@ -308,19 +533,25 @@ def checkout_start(update: Update, context: CallbackContext):
     user = data['users'].get(secret)
     cart = user.get('cart', [])
     if not cart:
-        update.message.reply_text('Your cart is empty. Add products first.')
+        safe_reply(update, 'Your cart is empty. Add products first.')
         return MAIN_MENU
-    update.message.reply_text('Please enter delivery address:')
+    # The rest of the checkout works from this copy instead of the stored cart
+    context.user_data['cart_snapshot'] = (list(cart), cart_total(user))
+    safe_reply(update, 'Please enter delivery address:')
     return CHECKOUT_ADDR
 
 
 def checkout_addr(update: Update, context: CallbackContext):
     addr = update.message.text.strip()
     # Encrypt address
-    encrypted_addr = encrypt_address(addr)
+    try:
+        encrypted_addr = encrypt_address(addr)
+    except RuntimeError:
+        safe_reply(update, 'Could not encrypt your address right now. Please try again later or /cancel.')
+        return CHECKOUT_ADDR
     context.user_data['addr'] = encrypted_addr
     context.user_data['addr_plain'] = addr  # Store plain for reference
-    update.message.reply_text('Address saved (encrypted). Any delivery notes? (or send "skip")')
+    safe_reply(update, 'Address saved (encrypted). Any delivery notes? (or send "skip")')
     return CHECKOUT_NOTES
 
 
@@ -330,138 +561,156 @@ def checkout_notes(update: Update, context: CallbackContext):
         context.user_data['notes'] = ''
     else:
         context.user_data['notes'] = notes
-    keyboard = ReplyKeyboardMarkup([['BTC', 'USDT']], one_time_keyboard=True, resize_keyboard=True)
-    update.message.reply_text('Choose payment type:', reply_markup=keyboard)
+    safe_reply(update, 'Choose payment type:', reply_markup=PAY_MARKUP)
     return CHECKOUT_PAYTYPE
 
 
 def checkout_paytype(update: Update, context: CallbackContext):
     pay = update.message.text.strip().upper()
     if pay not in ('BTC', 'USDT'):
-        update.message.reply_text('Invalid payment type. Choose BTC or USDT.')
+        safe_reply(update, 'Invalid payment type. Choose BTC or USDT.')
         return CHECKOUT_PAYTYPE
     
     secret = context.user_data.get('secret')
     data = load_data()
     user = data['users'].get(secret)
-    cart = user.get('cart', [])
+    snapshot = context.user_data.pop('cart_snapshot', None)
+    if snapshot:
+        cart, total = snapshot
+    else:
+        cart, total = user.get('cart', []), cart_total(user)
     if not cart:
-        update.message.reply_text('Your cart is empty. Aborting.')
+        safe_reply(update, 'Your cart is empty. Aborting.')
         return MAIN_MENU
     
-    order_id = str(int(time.time())) + '-' + uuid4().hex[:6]
-    order = {
-        'order_id': order_id,
-        'user': secret,
-        'items': cart.copy(),
-        'address_encrypted': context.user_data.get('addr'),
-        'notes': context.user_data.get('notes', ''),
-        'payment_type': pay,
-        'status': 'pending',
-        'timestamp': int(time.time())
-    }
-    data.setdefault('orders', []).append(order)
-    user.setdefault('orders', []).append(order_id)
-    user['cart'] = []
+    now = int(time.time())
+    order_id = f"{now}-{next(_ORDER_SEQ):06x}"
+    with _DATA_LOCK:
+        order = {
+            'order_id': order_id,
+            'user': secret,
+            'items': cart,
+            'address_encrypted': context.user_data.get('addr'),
+            'notes': context.user_data.get('notes', ''),
+            'payment_type': pay,
+            'status': 'pending',
+            'timestamp': now,
+            'total': total
+        }
+        data.setdefault('orders', []).append(order)
+        _OID_INDEX[order_id] = order
+        user.setdefault('orders', []).append(order_id)
+        # The order takes over the checked-out items; anything added since
+        # checkout_start stays in a fresh cart list
+        remaining = user.get('cart', [])[len(cart):]
+        user['cart_total'] = cart_total(user) - total if remaining else 0
+        user['cart'] = remaining
     save_data(data)
     
     payinfo = data.get('payment', {})
     addrinfo = payinfo.get('btc_address') if pay == 'BTC' else payinfo.get('usdt_address')
-    total = order_total(order)
     msg = "Order {} created!\nTotal: {:.2f} {}\nPay to: {}\n\nYour address is encrypted. Send /download_address {} to get your encrypted address file.\nThen send /track {} to see status.".format(
         order_id, total, pay, addrinfo, order_id, order_id)
-    update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
-    return show_main_menu(update, context)
+    # The main menu keyboard rides along with the confirmation, so the
+    # checkout ends in one message instead of two
+    safe_reply(update, msg, reply_markup=MAIN_MENU_MARKUP)
+    return MAIN_MENU
 
 
 def order_total(order):
-    return sum(item['price'] for item in order['items'])
+    total = order.get('total')
+    if total is None:  # orders created before the total was stored
+        total = sum(item['price'] for item in order['items'])
+    return total
+
+
+def cart_total(user):
+    """Running total of the user's cart, kept up to date by add_to_cart_callback."""
+    total = user.get('cart_total')
+    if total is None:  # carts filled before the total was tracked
+        total = sum(item['price'] for item in user.get('cart', []))
+    return total
 
 
 @ensure_user
 def track_order(update: Update, context: CallbackContext):
-    args = update.message.text.split()
-    if len(args) < 2:
-        update.message.reply_text('Usage: /track ORDER_ID')
+    if not context.args:
+        safe_reply(update, 'Usage: /track ORDER_ID')
         return
-    oid = args[1]
-    data = load_data()
-    for o in data.get('orders', []):
-        if o['order_id'] == oid:
-            update.message.reply_text("Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
-            return
-    update.message.reply_text('Order not found.')
+    oid = context.args[0]
+    load_data()  # refreshes _OID_INDEX if data.json changed on disk
+    o = _OID_INDEX.get(oid)
+    if o and o.get('user') == context.user_data.get('secret'):
+        safe_reply(update, "Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
+        return
+    safe_reply(update, 'Order not found.')
 
 
 @ensure_user
 def download_address(update: Update, context: CallbackContext):
     """Download encrypted address as a file."""
-    args = update.message.text.split()
-    if len(args) < 2:
-        update.message.reply_text('Usage: /download_address ORDER_ID')
+    if not context.args:
+        safe_reply(update, 'Usage: /download_address ORDER_ID')
         return
     
-    oid = args[1]
+    oid = context.args[0]
     secret = context.user_data.get('secret')
-    data = load_data()
+    load_data()  # refreshes _OID_INDEX if data.json changed on disk
     
-    # Find order
-    order = None
-    for o in data.get('orders', []):
-        if o['order_id'] == oid and o.get('user') == secret:
-            order = o
-            break
-    
-    if not order:
-        update.message.reply_text('Order not found or you do not have permission to access it.')
+    order = _OID_INDEX.get(oid)
+    if not order or order.get('user') != secret:
+        safe_reply(update, 'Order not found or you do not have permission to access it.')
         return
     
     encrypted_addr = order.get('address_encrypted', '')
     if not encrypted_addr:
-        update.message.reply_text('No encrypted address found for this order.')
+        safe_reply(update, 'No encrypted address found for this order.')
         return
     
-    # Create temporary file
+    # Send file straight from memory
     filename = "{}_address.asc".format(oid)
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(encrypted_addr)
-    
-    # Send file
-    with open(filepath, 'rb') as f:
-        update.message.reply_document(f, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
-    
-    # Clean up
-    try:
-        os.remove(filepath)
-    except:
-        pass
+    document = io.BytesIO(encrypted_addr.encode('utf-8'))
+    update.message.reply_document(document, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
 
 
 @ensure_user
 def order_history(update: Update, context: CallbackContext):
     secret = context.user_data.get('secret')
     data = load_data()
-    orders = [o for o in data.get('orders', []) if o.get('user') == secret]
+    user = data['users'].get(secret)
+    orders = [_OID_INDEX[oid] for oid in user.get('orders', []) if oid in _OID_INDEX]
     if not orders:
-        update.message.reply_text('No orders yet.')
+        safe_reply(update, 'No orders yet.')
         return MAIN_MENU
-    text = 'Your orders:\n'
+    parts = ['Your orders:\n']
     for o in orders:
-        oid = o['order_id']
-        status = o['status']
-        total = order_total(o)
-        text += "{} — {} — ${:.2f}\n".format(oid, status, total)
-    update.message.reply_text(text)
+        parts.append(f"{o['order_id']} — {o['status']} — ${order_total(o):.2f}\n")
+    safe_reply(update, ''.join(parts))
     return MAIN_MENU
 
 
 def cancel(update: Update, context: CallbackContext):
-    update.message.reply_text('Cancelled.', reply_markup=ReplyKeyboardRemove())
+    safe_reply(update, 'Cancelled.', reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
+# Main menu buttons -> handler, matched exactly against the message text
+MENU_ROUTES = {
+    'About': about,
+    'Products': list_categories,
+    'Cart': view_cart,
+    'Checkout': checkout_start,
+    'Order History': order_history,
+    'Support': support,
+}
+
+
+def main_menu_router(update: Update, context: CallbackContext):
+    handler = MENU_ROUTES.get(update.message.text)
+    if handler:
+        return handler(update, context)
+
+
 def main():
     updater = Updater(TOKEN, use_context=True)
     dp = updater.dispatcher
@@ -472,15 +721,8 @@ def main():
         states={
             ASK_SECRET: [MessageHandler(Filters.text & ~Filters.command, ask_country)],
             ASK_COUNTRY: [MessageHandler(Filters.text & ~Filters.command, save_country)],
-            MAIN_MENU: [
-                MessageHandler(Filters.regex('^About$'), about),
-                MessageHandler(Filters.regex('^Products$'), list_categories),
-                MessageHandler(Filters.regex('^Cart$'), view_cart),
-                MessageHandler(Filters.regex('^Checkout$'), checkout_start),
-                MessageHandler(Filters.regex('^Order History$'), order_history),
-                MessageHandler(Filters.regex('^Support$'), support),
-            ],
-            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr)],
+            MAIN_MENU: [MessageHandler(Filters.text & ~Filters.command, main_menu_router)],
+            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr, run_async=True)],
             CHECKOUT_NOTES: [MessageHandler(Filters.text & ~Filters.command, checkout_notes)],
             CHECKOUT_PAYTYPE: [MessageHandler(Filters.text & ~Filters.command, checkout_paytype)],
         },
@@ -489,15 +731,20 @@ def main():
     )
 
     dp.add_handler(conv)
-    dp.add_handler(CallbackQueryHandler(category_callback, pattern='^cat\|'))
-    dp.add_handler(CallbackQueryHandler(backcats_callback, pattern='^backcats$'))
-    dp.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern='^add\|'))
-    dp.add_handler(MessageHandler(Filters.regex('^/track'), track_order))
-    dp.add_handler(MessageHandler(Filters.regex('^/download_address'), download_address))
-
-    updater.start_polling()
+    dp.add_handler(CallbackQueryHandler(category_callback, pattern=CAT_RE))
+    dp.add_handler(CallbackQueryHandler(backcats_callback, pattern=BACKCATS_RE))
+    dp.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern=ADD_RE))
+    dp.add_handler(CommandHandler('track', track_order))
+    dp.add_handler(CommandHandler('download_address', download_address, run_async=True))
+
+    if WEBHOOK_URL:
+        updater.start_webhook(listen='0.0.0.0', port=WEBHOOK_PORT, url_path=TOKEN,
+                              webhook_url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), TOKEN))
+    else:
+        updater.start_polling()
     print('Bot started')
     updater.idle()
+    flush_data()
 
 
 if __name__ == '__main__':
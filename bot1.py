@@ -1,12 +1,28 @@
+import atexit
+import base64
+import io
+import itertools
 import json
 import logging
 import os
+import re
+import threading
 import time
+from collections import deque
 from functools import wraps
-from uuid import uuid4
 from dotenv import load_dotenv
 import gnupg
+try:
+    from orjson import dumps as _orjson_dumps, loads as _loads
+except ImportError:  # optional speedup, fall back to the stdlib parser
+    _orjson_dumps = None
+    _loads = json.loads
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # optional, only used when gpg cannot encrypt
+    AESGCM = None
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
+from telegram.error import RetryAfter
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler, CallbackContext)
 
 load_dotenv()
@@ -15,6 +31,11 @@ if not TOKEN:
     print("Please set TELEGRAM_TOKEN in environment or .env file")
     exit(1)
 
+# When set (e.g. https://example.com), Telegram pushes updates to a webhook
+# instead of the bot long-polling for them.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+
 DATA_FILE = os.path.join(os.path.dirname(__file__), 'data.json')
 GNUPG_HOME = os.path.join(os.path.dirname(__file__), '.gnupg')
 
@@ -37,92 +58,279 @@ ASK_SECRET, ASK_COUNTRY, MAIN_MENU, CHECKOUT_ADDR, CHECKOUT_NOTES, CHECKOUT_PAYT
 
 # Helper JSON functions
 
+# Parsed data.json. This process is its only writer, so it is read once
+# and every handler works on the same dict.
+_DATA = None
+# save_data() only flags the data as changed; a background thread writes it
+# out SAVE_DELAY seconds later, so a burst of changes costs a single write.
+SAVE_DELAY = 0.25
+_DIRTY = threading.Event()
+_WRITE_LOCK = threading.Lock()
+# Handlers run on a worker pool, so multi-step changes to the data hold this,
+# and the writer holds it while serializing, so no save captures half a change.
+_DATA_LOCK = threading.RLock()
+# telegram_id -> secret, built when the data is loaded and kept current on registration
+_TID_INDEX = {}
+_PID_INDEX = {}  # product id -> product
+_OID_INDEX = {}  # order id -> order
+# Source of the suffix of new order ids, continuing after the highest one on file
+_ORDER_SEQ = itertools.count(1)
+
+
+def _next_order_seq(orders):
+    seq = 0
+    for o in orders:
+        try:
+            seq = max(seq, int(o['order_id'].rsplit('-', 1)[1], 16))
+        except (IndexError, ValueError):
+            pass
+    return seq + 1
+
+
+def _index(data):
+    global _ORDER_SEQ
+    _TID_INDEX.clear()
+    _TID_INDEX.update((u['telegram_id'], s) for s, u in data.get('users', {}).items() if u.get('telegram_id'))
+    _PID_INDEX.clear()
+    _PID_INDEX.update((p['id'], p) for items in data.get('products', {}).values() for p in items)
+    _OID_INDEX.clear()
+    _OID_INDEX.update((o['order_id'], o) for o in data.get('orders', []))
+    _ORDER_SEQ = itertools.count(_next_order_seq(data.get('orders', [])))
+    for o in data.get('orders', []):
+        if 'total' not in o:
+            # Orders from before the total was stored at checkout
+            o['total'] = sum(item['price'] for item in o['items']) - (o.get('discount', 0) or 0)
+
+
 def load_data():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    global _DATA
+    if _DATA is None:
+        with open(DATA_FILE, 'rb') as f:
+            _DATA = _loads(f.read())
+        _index(_DATA)
+    return _DATA
 
 
 def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
+    """Schedule data to be written to disk."""
+    global _DATA
+    _DATA = data
+    _DIRTY.set()
 
 
-# PGP helper functions
-def generate_pgp_keys():
-    """Generate a PGP key pair if not exists."""
-    data = load_data()
-    pgp_config = data.get('pgp_config', {})
-
-    if pgp_config.get('key_generated'):
-        return pgp_config.get('public_key')
+def flush_data():
+    """Write the data now if it has unsaved changes."""
+    with _WRITE_LOCK:
+        if not _DIRTY.is_set():
+            return
+        _DIRTY.clear()
+        with _DATA_LOCK:
+            if _orjson_dumps is not None:
+                raw = _orjson_dumps(_DATA)
+            else:
+                raw = json.dumps(_DATA, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        # Write to a temp file and swap it in so a crash never leaves a torn data.json
+        tmp = DATA_FILE + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, DATA_FILE)
+        except Exception:
+            _DIRTY.set()  # still unsaved; the next flush retries it
+            raise
 
-    # Generate new key
-    input_data = gpg.gen_key_input(
-        key_type='RSA',
-        key_length=2048,
-        name_email='bot@ecommerce.local',
-        name_real='Ecommerce Bot'
-    )
-    key = gpg.gen_key(input_data)
-    key_id = str(key)
 
-    # Export public key
-    public_key = gpg.export_keys(key_id)
+def _writer_loop():
+    while True:
+        _DIRTY.wait()
+        time.sleep(SAVE_DELAY)
+        try:
+            flush_data()
+        except Exception:
+            logger.exception('Background save of %s failed', DATA_FILE)
 
-    # Save to data.json
-    data.setdefault('pgp_config', {})
-    data['pgp_config']['key_generated'] = True
-    data['pgp_config']['public_key'] = public_key
-    data['pgp_config']['key_id'] = key_id
-    save_data(data)
 
-    return public_key
+atexit.register(flush_data)
 
 
-def encrypt_address(address):
-    """Encrypt delivery address with the bot's public key."""
-    data = load_data()
-    public_key = data.get('pgp_config', {}).get('public_key')
+# PGP helper functions
 
-    if not public_key:
-        # Generate keys if not exists
-        public_key = generate_pgp_keys()
+# The bot's armored public key and its fingerprint in the local keyring,
+# resolved on first use
+_BOT_PUBKEY = None
+_BOT_KEY_FP = None
+_KEYGEN_LOCK = threading.Lock()
 
-    # Import public key
-    import_result = gpg.import_keys(public_key)
-    key_id = import_result.fingerprints[0] if import_result.fingerprints else None
 
-    if not key_id:
-        # Fallback: try to get from existing keys
+def generate_pgp_keys():
+    """Generate a PGP key pair if not exists."""
+    global _BOT_PUBKEY
+    if _BOT_PUBKEY is not None:
+        return _BOT_PUBKEY
+    # Two checkouts racing on a fresh install must not generate two keys
+    with _KEYGEN_LOCK:
         data = load_data()
-        key_id = data.get('pgp_config', {}).get('key_id')
+        pgp_config = data.get('pgp_config', {})
+
+        if pgp_config.get('key_generated'):
+            _BOT_PUBKEY = pgp_config.get('public_key')
+            return _BOT_PUBKEY
+
+        # Generate new key
+        # Curve25519 keys: much faster to generate than RSA-2048, with smaller
+        # keys and ciphertext
+        input_data = gpg.gen_key_input(
+            key_type='EDDSA',
+            key_curve='ed25519',
+            subkey_type='ECDH',
+            subkey_curve='cv25519',
+            name_email='bot@ecommerce.local',
+            name_real='Ecommerce Bot'
+        )
+        key = gpg.gen_key(input_data)
+        key_id = str(key)
+
+        # Export public key
+        public_key = gpg.export_keys(key_id)
+
+        # Save to data.json
+        with _DATA_LOCK:
+            data.setdefault('pgp_config', {})
+            data['pgp_config']['key_generated'] = True
+            data['pgp_config']['public_key'] = public_key
+            data['pgp_config']['key_id'] = key_id
+        save_data(data)
+
+        _BOT_PUBKEY = public_key
+        return public_key
+
+
+def encrypt_address(address):
+    """Encrypt delivery address with the bot's public key.
+
+    Raises RuntimeError if neither gpg nor the AES-GCM fallback can encrypt it.
+    """
+    global _BOT_KEY_FP
+    if _BOT_KEY_FP is None:
+        public_key = generate_pgp_keys()
+        # Import once per process: data.json may name a key this keyring has
+        # never seen (fresh deploy, restored data file)
+        import_result = gpg.import_keys(public_key)
+        if import_result.fingerprints:
+            _BOT_KEY_FP = import_result.fingerprints[0]
+        else:
+            _BOT_KEY_FP = load_data().get('pgp_config', {}).get('key_id')
 
     # Encrypt
-    encrypted_data = gpg.encrypt(address, key_id, always_trust=True)
+    encrypted_data = gpg.encrypt(address, _BOT_KEY_FP, always_trust=True)
+    if not encrypted_data.ok and AESGCM is not None:
+        logger.error('gpg encryption failed (%s), using AES-GCM instead', encrypted_data.status)
+        nonce = os.urandom(12)
+        sealed = AESGCM(_sym_key()).encrypt(nonce, address.encode('utf-8'), None)
+        return SYM_PREFIX + base64.b64encode(nonce + sealed).decode('ascii')
+    if not encrypted_data.ok:
+        logger.error('Address encryption failed: %s', encrypted_data.status)
+        raise RuntimeError('address encryption failed')
     return str(encrypted_data)
 
 
 def decrypt_address(encrypted_address):
     """Decrypt delivery address."""
+    if encrypted_address.startswith(SYM_PREFIX):
+        if AESGCM is None:
+            logger.error('Cannot decrypt an AES-GCM address: the cryptography package is not installed')
+            return ''
+        raw = base64.b64decode(encrypted_address[len(SYM_PREFIX):])
+        return AESGCM(_sym_key()).decrypt(raw[:12], raw[12:], None).decode('utf-8')
     decrypted_data = gpg.decrypt(encrypted_address)
     return str(decrypted_data)
 
 
+# Addresses encrypted with the symmetric fallback key carry this prefix
+SYM_PREFIX = 'AESGCM:'
+
+
+def _sym_key():
+    """Return the bot's AES-256 key, generating it on first use."""
+    with _KEYGEN_LOCK:
+        data = load_data()
+        key = data.get('pgp_config', {}).get('sym_key')
+        if key:
+            return base64.b64decode(key)
+        key = AESGCM.generate_key(bit_length=256)
+        with _DATA_LOCK:
+            data.setdefault('pgp_config', {})['sym_key'] = base64.b64encode(key).decode('ascii')
+        save_data(data)
+        return key
+
+
+# Outbound message helpers
+
+# Telegram allows about 30 messages per second per bot; stay a little below it.
+MAX_SENDS_PER_SECOND = 25
+# ...and about one message per second to the same chat, allowing a short
+# burst so a reply followed by a menu is not held back.
+PER_CHAT_INTERVAL = 1.0
+PER_CHAT_BURST = 3
+_SEND_TIMES = deque()
+_CHAT_NEXT_SEND = {}  # chat_id -> time.monotonic() up to which its sends are booked
+_SEND_LOCK = threading.Lock()
+
+
+def _throttle(chat_id=None):
+    if chat_id is not None:
+        # Reserve this chat's next slot under the lock but sleep outside it,
+        # so a busy chat does not hold up sends to other chats.
+        with _SEND_LOCK:
+            now = time.monotonic()
+            booked = max(now, _CHAT_NEXT_SEND.get(chat_id, 0))
+            _CHAT_NEXT_SEND[chat_id] = booked + PER_CHAT_INTERVAL
+        wait = booked - now - (PER_CHAT_BURST - 1) * PER_CHAT_INTERVAL
+        if wait > 0:
+            time.sleep(wait)
+    with _SEND_LOCK:
+        now = time.monotonic()
+        while _SEND_TIMES and now - _SEND_TIMES[0] >= 1:
+            _SEND_TIMES.popleft()
+        if len(_SEND_TIMES) >= MAX_SENDS_PER_SECOND:
+            time.sleep(1 - (now - _SEND_TIMES[0]))
+            _SEND_TIMES.popleft()
+        _SEND_TIMES.append(time.monotonic())
+
+
+def send_with_retry(method, *args, chat=None, **kwargs):
+    """Call a Bot API method, pacing sends and waiting out flood limits.
+
+    Pass the id of the target chat as ``chat`` to also keep to the per-chat limit.
+    """
+    while True:
+        _throttle(chat)
+        try:
+            return method(*args, **kwargs)
+        except RetryAfter as e:
+            logger.warning('Flood limit hit, retrying in %s seconds', e.retry_after)
+            time.sleep(e.retry_after)
+
+
+def safe_reply(update: Update, text, **kwargs):
+    return send_with_retry(update.message.reply_text, text, chat=update.effective_chat.id, **kwargs)
+
+
+def safe_edit(update: Update, text, **kwargs):
+    return send_with_retry(update.callback_query.edit_message_text, text, chat=update.effective_chat.id, **kwargs)
+
+
 # Decorator to ensure user exists
 def ensure_user(func):
     @wraps(func)
     def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
         user = update.effective_user
-        data = load_data()
-        # try to find user by telegram id
-        found = None
-        for secret, u in data.get('users', {}).items():
-            if u.get('telegram_id') == user.id:
-                found = secret
-                break
+        found = _TID_INDEX.get(user.id)
         if not found:
             # Not registered
-            update.message.reply_text("You need to /start and register with a secret phrase first.")
+            safe_reply(update, "You need to /start and register with a secret phrase first.")
             return ConversationHandler.END
         context.user_data['secret'] = found
         return func(update, context, *args, **kwargs)
@@ -133,17 +341,12 @@ def ensure_user(func):
 def start(update: Update, context: CallbackContext):
     # If user already registered, show the start menu; otherwise begin registration
     user = update.effective_user
-    data = load_data()
-    found = None
-    for secret, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user.id:
-            found = secret
-            break
+    found = _TID_INDEX.get(user.id)
     if found:
         context.user_data['secret'] = found
         return send_start_menu(update, context)
 
-    update.message.reply_text(
+    safe_reply(update,
         "Welcome! Please send me your secret key phrase (this identifies you).\n"
         "Pick something unique — this will be used as your account identifier.")
     return ASK_SECRET
@@ -155,23 +358,23 @@ def ask_country(update: Update, context: CallbackContext):
     users = data.setdefault('users', {})
 
     if secret in users:
-        update.message.reply_text("This secret phrase is already registered. Welcome back!")
+        safe_reply(update, "This secret phrase is already registered. Welcome back!")
     else:
-        users[secret] = {
+        # Kept in the session until a country is chosen; save_country stores it
+        context.user_data['pending_user'] = {
             'username': update.effective_user.username or '',
             'telegram_id': update.effective_user.id,
             'country': None,
             'cart': [],
             'orders': []
         }
-        save_data(data)
-        update.message.reply_text("Secret saved!")
+        safe_reply(update, "Secret saved!")
 
     # country selection keyboard
     countries = ['USA', 'UK', 'Nigeria', 'India', 'Other']
     keyboard = ReplyKeyboardMarkup([[c] for c in countries], one_time_keyboard=True, resize_keyboard=True)
     context.user_data['pending_secret'] = secret
-    update.message.reply_text('Please choose your country:', reply_markup=keyboard)
+    safe_reply(update, 'Please choose your country:', reply_markup=keyboard)
     return ASK_COUNTRY
 
 
@@ -179,21 +382,29 @@ def save_country(update: Update, context: CallbackContext):
     country = update.message.text.strip()
     secret = context.user_data.get('pending_secret')
     if not secret:
-        update.message.reply_text('Session expired, please /start again.', reply_markup=ReplyKeyboardRemove())
+        safe_reply(update, 'Session expired, please /start again.', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
     data = load_data()
-    users = data.setdefault('users', {})
-    user = users.get(secret)
+    pending = context.user_data.pop('pending_user', None)
+    with _DATA_LOCK:
+        users = data.setdefault('users', {})
+        user = users.get(secret)
+        if not user and pending:
+            user = users[secret] = pending
+        if user:
+            user['country'] = country
+            user['username'] = update.effective_user.username or user.get('username', '')
+            if user.get('telegram_id') != update.effective_user.id:
+                _TID_INDEX.pop(user.get('telegram_id'), None)
+            user['telegram_id'] = update.effective_user.id
+            _TID_INDEX[user['telegram_id']] = secret
     if not user:
-        update.message.reply_text('User not found. Please /start again.', reply_markup=ReplyKeyboardRemove())
+        safe_reply(update, 'User not found. Please /start again.', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    user['country'] = country
-    user['username'] = update.effective_user.username or user.get('username', '')
-    user['telegram_id'] = update.effective_user.id
     save_data(data)
     context.user_data['secret'] = secret
 
-    update.message.reply_text('Registration complete. Welcome!', reply_markup=ReplyKeyboardRemove())
+    safe_reply(update, 'Registration complete. Welcome!', reply_markup=ReplyKeyboardRemove())
     return send_start_menu(update, context)
 
 
@@ -207,21 +418,21 @@ def show_main_menu(update: Update, context: CallbackContext):
     ]
     if update.callback_query:
         update.callback_query.answer()
-        update.callback_query.edit_message_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        safe_edit(update, 'Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     else:
-        update.message.reply_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        safe_reply(update, 'Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return MAIN_MENU
 
 
 @ensure_user
 def about(update: Update, context: CallbackContext):
-    update.message.reply_text('This is a demo ecommerce bot. You can browse products, add to cart, and checkout.')
+    safe_reply(update, 'This is a demo ecommerce bot. You can browse products, add to cart, and checkout.')
     return MAIN_MENU
 
 
 @ensure_user
 def support(update: Update, context: CallbackContext):
-    update.message.reply_text('Support: contact support@example.com or reply here and an agent will reach out.')
+    safe_reply(update, 'Support: contact support@example.com or reply here and an agent will reach out.')
     return MAIN_MENU
 
 
@@ -230,10 +441,10 @@ def list_categories(update: Update, context: CallbackContext):
     data = load_data()
     cats = list(data.get('products', {}).keys())
     if not cats:
-        update.message.reply_text('No product categories available.')
+        safe_reply(update, 'No product categories available.')
         return MAIN_MENU
     buttons = [[InlineKeyboardButton(c, callback_data='cat|{}'.format(c))] for c in cats]
-    update.message.reply_text('Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
+    safe_reply(update, 'Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
     return MAIN_MENU
 
 
@@ -244,7 +455,7 @@ def category_callback(update: Update, context: CallbackContext):
     data = load_data()
     products = data.get('products', {}).get(cat, [])
     if not products:
-        query.edit_message_text('No products in this category.')
+        safe_edit(update, 'No products in this category.')
         return
     text = "Products in {}:\n".format(cat)
     buttons = []
@@ -259,7 +470,7 @@ def category_callback(update: Update, context: CallbackContext):
             InlineKeyboardButton("❤️ Wishlist", callback_data='wish|{}'.format(pid))
         ])
     buttons.append([InlineKeyboardButton('Back to categories', callback_data='backcats')])
-    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    safe_edit(update, text, reply_markup=InlineKeyboardMarkup(buttons))
 
 
 def backcats_callback(update: Update, context: CallbackContext):
@@ -273,28 +484,20 @@ def add_to_cart_callback(update: Update, context: CallbackContext):
     query.answer()
     _, pid = query.data.split('|', 1)
     data = load_data()
-    product = None
-    for cat, items in data.get('products', {}).items():
-        for p in items:
-            if p['id'] == pid:
-                product = p
-                break
+    product = _PID_INDEX.get(pid)
     if not product:
-        query.edit_message_text('Product not found.')
+        safe_edit(update, 'Product not found.')
         return
     # find user by telegram id
-    user = update.effective_user
-    secret = None
-    for s, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user.id:
-            secret = s
-            break
+    secret = _TID_INDEX.get(update.effective_user.id)
     if not secret:
-        query.edit_message_text('User not registered. Use /start to register.')
+        safe_edit(update, 'User not registered. Use /start to register.')
         return
     users = data['users']
-    cart = users[secret].setdefault('cart', [])
-    cart.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
+    # checkout_paytype runs on the worker pool and takes the cart under this lock
+    with _DATA_LOCK:
+        cart = users[secret].setdefault('cart', [])
+        cart.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
     save_data(data)
     query.answer("Added {} to cart.".format(product['name']), show_alert=True)
 
@@ -306,7 +509,7 @@ def view_cart(update: Update, context: CallbackContext):
     user = data['users'].get(secret)
     cart = user.get('cart', [])
     if not cart:
-        update.message.reply_text('Your cart is empty.')
+        safe_reply(update, 'Your cart is empty.')
         return MAIN_MENU
     text = 'Your cart:\n'
     total = 0
@@ -314,7 +517,7 @@ def view_cart(update: Update, context: CallbackContext):
         text += "{0}. {1} — ${2}\n".format(idx, item['name'], item['price'])
         total += item['price']
     text += "\nTotal: ${:.2f}".format(total)
-    update.message.reply_text(text)
+    safe_reply(update, text)
     return MAIN_MENU
 
 
@@ -325,19 +528,23 @@ def checkout_start(update: Update, context: CallbackContext):
     user = data['users'].get(secret)
     cart = user.get('cart', [])
     if not cart:
-        update.message.reply_text('Your cart is empty. Add products first.')
+        safe_reply(update, 'Your cart is empty. Add products first.')
         return MAIN_MENU
-    update.message.reply_text('Please enter delivery address:')
+    safe_reply(update, 'Please enter delivery address:')
     return CHECKOUT_ADDR
 
 
 def checkout_addr(update: Update, context: CallbackContext):
     addr = update.message.text.strip()
     # Encrypt address
-    encrypted_addr = encrypt_address(addr)
+    try:
+        encrypted_addr = encrypt_address(addr)
+    except RuntimeError:
+        safe_reply(update, 'Could not encrypt your address right now. Please try again later or /cancel.')
+        return CHECKOUT_ADDR
     context.user_data['addr'] = encrypted_addr
     context.user_data['addr_plain'] = addr  # Store plain for reference
-    update.message.reply_text('Address saved (encrypted). Any delivery notes? (or send "skip")')
+    safe_reply(update, 'Address saved (encrypted). Any delivery notes? (or send "skip")')
     return CHECKOUT_NOTES
 
 
@@ -348,14 +555,14 @@ def checkout_notes(update: Update, context: CallbackContext):
     else:
         context.user_data['notes'] = notes
     keyboard = ReplyKeyboardMarkup([['BTC', 'USDT']], one_time_keyboard=True, resize_keyboard=True)
-    update.message.reply_text('Choose payment type:', reply_markup=keyboard)
+    safe_reply(update, 'Choose payment type:', reply_markup=keyboard)
     return CHECKOUT_PAYTYPE
 
 
 def checkout_paytype(update: Update, context: CallbackContext):
     pay = update.message.text.strip().upper()
     if pay not in ('BTC', 'USDT'):
-        update.message.reply_text('Invalid payment type. Choose BTC or USDT.')
+        safe_reply(update, 'Invalid payment type. Choose BTC or USDT.')
         return CHECKOUT_PAYTYPE
 
     secret = context.user_data.get('secret')
@@ -363,37 +570,43 @@ def checkout_paytype(update: Update, context: CallbackContext):
     user = data['users'].get(secret)
     cart = user.get('cart', [])
     if not cart:
-        update.message.reply_text('Your cart is empty. Aborting.')
+        safe_reply(update, 'Your cart is empty. Aborting.')
         return MAIN_MENU
 
+    # Charge exactly the items that go on the order; clicks may still be
+    # adding to the live cart while this handler runs
+    items = list(cart)
     # Calculate totals and apply coupon if available
-    subtotal = sum(item['price'] for item in cart)
+    subtotal = sum(item['price'] for item in items)
     discount = 0.0
     if user.get('coupon') == 'SAVE10':
         discount = round(subtotal * 0.10, 2)
     total_amount = round(subtotal - discount, 2)
 
-    order_id = str(int(time.time())) + '-' + uuid4().hex[:6]
-    order = {
-        'order_id': order_id,
-        'user': secret,
-        'items': cart.copy(),
-        'address_encrypted': context.user_data.get('addr'),
-        'notes': context.user_data.get('notes', ''),
-        'payment_type': pay,
-        'status': 'pending',
-        'timestamp': int(time.time()),
-        'subtotal': subtotal,
-        'discount': discount,
-        'total': total_amount,
-        'coupon': user.get('coupon') if discount > 0 else ''
-    }
-    data.setdefault('orders', []).append(order)
-    user.setdefault('orders', []).append(order_id)
-    user['cart'] = []
-    # Clear coupon after use
-    if 'coupon' in user:
-        user.pop('coupon', None)
+    order_id = f"{int(time.time())}-{next(_ORDER_SEQ):06x}"
+    with _DATA_LOCK:
+        order = {
+            'order_id': order_id,
+            'user': secret,
+            'items': items,
+            'address_encrypted': context.user_data.get('addr'),
+            'notes': context.user_data.get('notes', ''),
+            'payment_type': pay,
+            'status': 'pending',
+            'timestamp': int(time.time()),
+            'subtotal': subtotal,
+            'discount': discount,
+            'total': total_amount,
+            'coupon': user.get('coupon') if discount > 0 else ''
+        }
+        data.setdefault('orders', []).append(order)
+        _OID_INDEX[order_id] = order
+        user.setdefault('orders', []).append(order_id)
+        # Items added after the snapshot stay in the cart for the next order
+        user['cart'] = user.get('cart', [])[len(items):]
+        # Clear coupon after use
+        if 'coupon' in user:
+            user.pop('coupon', None)
     save_data(data)
 
     payinfo = data.get('payment', {})
@@ -408,84 +621,70 @@ def checkout_paytype(update: Update, context: CallbackContext):
     msg_lines.append("")
     msg_lines.append("Your address is encrypted. Send /download_address {} to get your encrypted address file.".format(order_id))
     msg_lines.append("Then send /track {} to see status.".format(order_id))
-    update.message.reply_text("\n".join(msg_lines), reply_markup=ReplyKeyboardRemove())
+    safe_reply(update, "\n".join(msg_lines), reply_markup=ReplyKeyboardRemove())
     return send_start_menu(update, context)
 
 
+def user_orders(user):
+    """Return the user's orders, oldest first."""
+    return [_OID_INDEX[oid] for oid in user.get('orders', []) if oid in _OID_INDEX]
+
+
 def order_total(order):
-    subtotal = sum(item['price'] for item in order['items'])
-    discount = order.get('discount', 0) or 0
-    return subtotal - discount
+    # Stored at checkout, and backfilled for older orders when data.json is loaded
+    return order['total']
 
 
 @ensure_user
 def track_order(update: Update, context: CallbackContext):
-    args = update.message.text.split()
-    if len(args) < 2:
-        update.message.reply_text('Usage: /track ORDER_ID')
+    if not context.args:
+        safe_reply(update, 'Usage: /track ORDER_ID')
         return
-    oid = args[1]
-    data = load_data()
-    for o in data.get('orders', []):
-        if o['order_id'] == oid:
-            update.message.reply_text("Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
-            return
-    update.message.reply_text('Order not found.')
+    oid = context.args[0]
+    o = _OID_INDEX.get(oid)
+    if o:
+        safe_reply(update, "Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
+        return
+    safe_reply(update, 'Order not found.')
 
 
 @ensure_user
 def download_address(update: Update, context: CallbackContext):
     """Download encrypted address as a file."""
-    args = update.message.text.split()
-    if len(args) < 2:
-        update.message.reply_text('Usage: /download_address ORDER_ID')
+    if not context.args:
+        safe_reply(update, 'Usage: /download_address ORDER_ID')
         return
 
-    oid = args[1]
+    oid = context.args[0]
     secret = context.user_data.get('secret')
-    data = load_data()
-
-    # Find order
-    order = None
-    for o in data.get('orders', []):
-        if o['order_id'] == oid and o.get('user') == secret:
-            order = o
-            break
 
-    if not order:
-        update.message.reply_text('Order not found or you do not have permission to access it.')
+    order = _OID_INDEX.get(oid)
+    if not order or order.get('user') != secret:
+        safe_reply(update, 'Order not found or you do not have permission to access it.')
         return
 
     encrypted_addr = order.get('address_encrypted', '')
     if not encrypted_addr:
-        update.message.reply_text('No encrypted address found for this order.')
+        safe_reply(update, 'No encrypted address found for this order.')
+        return
+    if encrypted_addr.startswith(SYM_PREFIX):
+        # Not OpenPGP, and its key never leaves data.json; an .asc file would be useless
+        safe_reply(update, 'The address for this order was not PGP-encrypted, so it cannot be downloaded as a PGP file.')
         return
 
-    # Create temporary file
+    # Send file straight from memory
     filename = "{}_address.asc".format(oid)
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(encrypted_addr)
-
-    # Send file
-    with open(filepath, 'rb') as f:
-        update.message.reply_document(f, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
-
-    # Clean up
-    try:
-        os.remove(filepath)
-    except:
-        pass
+    document = io.BytesIO(encrypted_addr.encode('utf-8'))
+    update.message.reply_document(document, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
 
 
 @ensure_user
 def order_history(update: Update, context: CallbackContext):
     secret = context.user_data.get('secret')
     data = load_data()
-    orders = [o for o in data.get('orders', []) if o.get('user') == secret]
+    orders = user_orders(data['users'][secret])
     if not orders:
-        update.message.reply_text('No orders yet.')
+        safe_reply(update, 'No orders yet.')
         return MAIN_MENU
     text = 'Your orders:\n'
     for o in orders:
@@ -493,23 +692,19 @@ def order_history(update: Update, context: CallbackContext):
         status = o['status']
         total = order_total(o)
         text += "{} — {} — ${:.2f}\n".format(oid, status, total)
-    update.message.reply_text(text)
+    safe_reply(update, text)
     return MAIN_MENU
 
 
 def cancel(update: Update, context: CallbackContext):
-    update.message.reply_text('Cancelled.', reply_markup=ReplyKeyboardRemove())
+    safe_reply(update, 'Cancelled.', reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
 # Helper: find user secret by telegram id
 
 def find_secret_by_user_id(user_id):
-    data = load_data()
-    for s, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user_id:
-            return s
-    return None
+    return _TID_INDEX.get(user_id)
 
 
 # Start menu with inline buttons
@@ -530,139 +725,169 @@ def send_start_menu(update: Update, context: CallbackContext):
     markup = InlineKeyboardMarkup(keyboard)
     if getattr(update, 'callback_query', None):
         update.callback_query.answer()
-        update.callback_query.edit_message_text(text, reply_markup=markup, disable_web_page_preview=True)
+        safe_edit(update, text, reply_markup=markup, disable_web_page_preview=True)
     else:
-        update.message.reply_text(text, reply_markup=markup, disable_web_page_preview=True)
+        safe_reply(update, text, reply_markup=markup, disable_web_page_preview=True)
     return MAIN_MENU
 
 
 # Central menu callback
 
+# Inline main-menu sections, one function per menu|<choice> button
+
+def _menu_products(update, context, data, secret):
+    cats = list(data.get('products', {}).keys())
+    if not cats:
+        safe_edit(update, 'No product categories available.')
+        return
+    buttons = [[InlineKeyboardButton(c, callback_data=f'cat|{c}')] for c in cats]
+    buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
+    safe_edit(update, 'Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_coupon(update, context, data, secret):
+    text = (
+        "🎟️ 10% OFF COUPON\n"
+        "Use code SAVE10. Tap Apply Coupon to attach it to your next order."
+    )
+    buttons = [
+        [InlineKeyboardButton('✅ Apply Coupon', callback_data='applycoupon')],
+        [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
+    ]
+    safe_edit(update, text, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_cart(update, context, data, secret):
+    if not secret:
+        safe_edit(update, 'Please /start to register first.')
+        return
+    user = data['users'][secret]
+    cart = user.get('cart', [])
+    if not cart:
+        txt = '🛒 Your cart is empty.'
+    else:
+        total = sum(i['price'] for i in cart)
+        lines = ['🛒 Your cart:']
+        for idx, item in enumerate(cart, 1):
+            lines.append(f"{idx}. {item['name']} — ${item['price']}")
+        if user.get('coupon') == 'SAVE10':
+            lines.append("\n🎟️ Coupon applied: -10% (will apply at checkout)")
+        lines.append(f"\nSubtotal: ${total:.2f}")
+        txt = "\n".join(lines)
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_wishlist(update, context, data, secret):
+    if not secret:
+        safe_edit(update, 'Please /start to register first.')
+        return
+    user = data['users'][secret]
+    wl = user.get('wishlist', [])
+    if not wl:
+        txt = '💖 Your wishlist is empty.'
+    else:
+        lines = ['💖 Your wishlist:']
+        for idx, item in enumerate(wl, 1):
+            lines.append(f"{idx}. {item['name']} — ${item['price']}")
+        txt = "\n".join(lines)
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_pgp(update, context, data, secret):
+    txt = (
+        "🔐 PGP Address Encryption\n"
+        "Your delivery address is encrypted before storage. You can also import the bot's public key to encrypt messages to us."
+    )
+    buttons = [
+        [InlineKeyboardButton('📄 Get Public Key', callback_data='getpub')],
+        [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
+    ]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_about(update, context, data, secret):
+    txt = 'ℹ️ About\nThis is a demo ecommerce bot. Browse products, add to cart, and checkout securely with PGP.'
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_track(update, context, data, secret):
+    txt = "🛰️ Track Orders\nSend the command:\n/track ORDER_ID"
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_ratings(update, context, data, secret):
+    ratings = data.get('ratings', [])
+    if ratings:
+        avg = sum(r['value'] for r in ratings) / len(ratings)
+        stats = f"{len(ratings)} ratings, average {avg:.1f} ⭐"
+    else:
+        stats = "No ratings yet."
+    buttons = [[InlineKeyboardButton('⭐' * i, callback_data=f'rate|{i}')] for i in range(1, 6)]
+    buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
+    safe_edit(update, f"⭐ Ratings\n{stats}\nTap to rate:", reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_contact(update, context, data, secret):
+    txt = "📞 Contact\nSupport: support@example.com\nOr reply here and an agent will reach out."
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_others(update, context, data, secret):
+    buttons = [
+        [InlineKeyboardButton('🧾 Order History', callback_data='menu|history')],
+        [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
+    ]
+    safe_edit(update, '➕ Others', reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_history(update, context, data, secret):
+    if not secret:
+        safe_edit(update, 'Please /start to register first.')
+        return
+    orders = user_orders(data['users'][secret])
+    if not orders:
+        txt = 'No orders yet.'
+    else:
+        lines = ['🧾 Your orders:']
+        for o in orders:
+            lines.append(f"{o['order_id']} — {o['status']} — ${order_total(o):.2f}")
+        txt = "\n".join(lines)
+    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
+    safe_edit(update, txt, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+def _menu_main(update, context, data, secret):
+    send_start_menu(update, context)
+
+
+MENU_SECTIONS = {
+    'products': _menu_products,
+    'coupon': _menu_coupon,
+    'cart': _menu_cart,
+    'wishlist': _menu_wishlist,
+    'pgp': _menu_pgp,
+    'about': _menu_about,
+    'track': _menu_track,
+    'ratings': _menu_ratings,
+    'contact': _menu_contact,
+    'others': _menu_others,
+    'history': _menu_history,
+    'main': _menu_main,
+}
+
+
 def menu_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     choice = query.data.split('|', 1)[1]
-    user_id = update.effective_user.id
-    data = load_data()
-    secret = find_secret_by_user_id(user_id)
-
-    if choice == 'products':
-        cats = list(data.get('products', {}).keys())
-        if not cats:
-            query.edit_message_text('No product categories available.')
-            return
-        buttons = [[InlineKeyboardButton(c, callback_data=f'cat|{c}')] for c in cats]
-        buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
-        query.edit_message_text('Product categories:', reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'coupon':
-        text = (
-            "🎟️ 10% OFF COUPON\n"
-            "Use code SAVE10. Tap Apply Coupon to attach it to your next order."
-        )
-        buttons = [
-            [InlineKeyboardButton('✅ Apply Coupon', callback_data='applycoupon')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
-        query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'cart':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
-        user = data['users'][secret]
-        cart = user.get('cart', [])
-        if not cart:
-            txt = '🛒 Your cart is empty.'
-        else:
-            total = sum(i['price'] for i in cart)
-            lines = ['🛒 Your cart:']
-            for idx, item in enumerate(cart, 1):
-                lines.append(f"{idx}. {item['name']} — ${item['price']}")
-            if user.get('coupon') == 'SAVE10':
-                lines.append("\n🎟️ Coupon applied: -10% (will apply at checkout)")
-            lines.append(f"\nSubtotal: ${total:.2f}")
-            txt = "\n".join(lines)
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'wishlist':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
-        user = data['users'][secret]
-        wl = user.get('wishlist', [])
-        if not wl:
-            txt = '💖 Your wishlist is empty.'
-        else:
-            lines = ['💖 Your wishlist:']
-            for idx, item in enumerate(wl, 1):
-                lines.append(f"{idx}. {item['name']} — ${item['price']}")
-            txt = "\n".join(lines)
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'pgp':
-        txt = (
-            "🔐 PGP Address Encryption\n"
-            "Your delivery address is encrypted before storage. You can also import the bot's public key to encrypt messages to us."
-        )
-        buttons = [
-            [InlineKeyboardButton('📄 Get Public Key', callback_data='getpub')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'about':
-        txt = 'ℹ️ About\nThis is a demo ecommerce bot. Browse products, add to cart, and checkout securely with PGP.'
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'track':
-        txt = "🛰️ Track Orders\nSend the command:\n/track ORDER_ID"
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'ratings':
-        ratings = data.get('ratings', [])
-        if ratings:
-            avg = sum(r['value'] for r in ratings) / len(ratings)
-            stats = f"{len(ratings)} ratings, average {avg:.1f} ⭐"
-        else:
-            stats = "No ratings yet."
-        buttons = [[InlineKeyboardButton('⭐' * i, callback_data=f'rate|{i}')] for i in range(1, 6)]
-        buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
-        query.edit_message_text(f"⭐ Ratings\n{stats}\nTap to rate:", reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'contact':
-        txt = "📞 Contact\nSupport: support@example.com\nOr reply here and an agent will reach out."
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'others':
-        buttons = [
-            [InlineKeyboardButton('🧾 Order History', callback_data='menu|history')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
-        query.edit_message_text('➕ Others', reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'history':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
-        orders = [o for o in data.get('orders', []) if o.get('user') == secret]
-        if not orders:
-            txt = 'No orders yet.'
-        else:
-            lines = ['🧾 Your orders:']
-            for o in orders:
-                lines.append(f"{o['order_id']} — {o['status']} — ${order_total(o):.2f}")
-            txt = "\n".join(lines)
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    elif choice == 'main':
-        send_start_menu(update, context)
+    section = MENU_SECTIONS.get(choice)
+    if section:
+        section(update, context, load_data(), find_secret_by_user_id(update.effective_user.id))
 
 
 # Apply coupon callback
@@ -672,14 +897,14 @@ def applycoupon_callback(update: Update, context: CallbackContext):
     query.answer()
     secret = find_secret_by_user_id(update.effective_user.id)
     if not secret:
-        query.edit_message_text('Please /start to register first.')
+        safe_edit(update, 'Please /start to register first.')
         return
     data = load_data()
     user = data['users'].get(secret)
     user['coupon'] = 'SAVE10'
     save_data(data)
     buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-    query.edit_message_text('✅ Coupon applied. You will get 10% off at checkout.', reply_markup=InlineKeyboardMarkup(buttons))
+    safe_edit(update, '✅ Coupon applied. You will get 10% off at checkout.', reply_markup=InlineKeyboardMarkup(buttons))
 
 
 # Wishlist add callback
@@ -689,21 +914,13 @@ def wish_callback(update: Update, context: CallbackContext):
     query.answer()
     secret = find_secret_by_user_id(update.effective_user.id)
     if not secret:
-        query.edit_message_text('Please /start to register first.')
+        safe_edit(update, 'Please /start to register first.')
         return
     data = load_data()
-    # Find product by id
     _prefix, pid = query.data.split('|', 1)
-    product = None
-    for cat, items in data.get('products', {}).items():
-        for p in items:
-            if p['id'] == pid:
-                product = p
-                break
-        if product:
-            break
+    product = _PID_INDEX.get(pid)
     if not product:
-        query.edit_message_text('Product not found.')
+        safe_edit(update, 'Product not found.')
         return
     user = data['users'][secret]
     wl = user.setdefault('wishlist', [])
@@ -720,18 +937,8 @@ def send_public_key_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     public_key = generate_pgp_keys()
-    filename = 'bot_public_key.asc'
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(public_key)
-    try:
-        with open(filepath, 'rb') as f:
-            context.bot.send_document(update.effective_chat.id, f, filename=filename, caption='PGP Public Key')
-    finally:
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
+    document = io.BytesIO(public_key.encode('utf-8'))
+    context.bot.send_document(update.effective_chat.id, document, filename='bot_public_key.asc', caption='PGP Public Key')
 
 
 # Rating submission
@@ -745,18 +952,39 @@ def rate_callback(update: Update, context: CallbackContext):
         if rating < 1 or rating > 5:
             raise ValueError
     except Exception:
-        query.edit_message_text('Invalid rating value.')
+        safe_edit(update, 'Invalid rating value.')
         return
     secret = find_secret_by_user_id(update.effective_user.id) or 'anonymous'
     data = load_data()
     entry = {'user': secret, 'value': rating, 'ts': int(time.time())}
     data.setdefault('ratings', []).append(entry)
     save_data(data)
-    query.edit_message_text(f'Thanks for rating {"⭐" * rating}!')
+    safe_edit(update, f'Thanks for rating {"⭐" * rating}!')
+
+
+# Reply-keyboard buttons of the main menu, each matched exactly
+ABOUT_RE = re.compile(r'^About$')
+PRODUCTS_RE = re.compile(r'^Products$')
+CART_RE = re.compile(r'^Cart$')
+CHECKOUT_RE = re.compile(r'^Checkout$')
+HISTORY_RE = re.compile(r'^Order History$')
+SUPPORT_RE = re.compile(r'^Support$')
+# Inline button callback_data prefixes
+CAT_RE = re.compile(r'^cat\|')
+BACKCATS_RE = re.compile(r'^backcats$')
+ADD_RE = re.compile(r'^add\|')
+MENU_RE = re.compile(r'^menu\|')
+APPLYCOUPON_RE = re.compile(r'^applycoupon$')
+WISH_RE = re.compile(r'^wish\|')
+GETPUB_RE = re.compile(r'^getpub$')
+RATE_RE = re.compile(r'^rate\|')
 
 
 def main():
-    updater = Updater(TOKEN, use_context=True)
+    load_data()  # parse data.json and build the indexes before serving updates
+    threading.Thread(target=_writer_loop, name='data-writer', daemon=True).start()
+    # Checkout, key and file handlers run on this pool instead of the dispatcher thread
+    updater = Updater(TOKEN, use_context=True, workers=16)
     dp = updater.dispatcher
 
     # Main conversation handler
@@ -766,16 +994,16 @@ def main():
             ASK_SECRET: [MessageHandler(Filters.text & ~Filters.command, ask_country)],
             ASK_COUNTRY: [MessageHandler(Filters.text & ~Filters.command, save_country)],
             MAIN_MENU: [
-                MessageHandler(Filters.regex('^About$'), about),
-                MessageHandler(Filters.regex('^Products$'), list_categories),
-                MessageHandler(Filters.regex('^Cart$'), view_cart),
-                MessageHandler(Filters.regex('^Checkout$'), checkout_start),
-                MessageHandler(Filters.regex('^Order History$'), order_history),
-                MessageHandler(Filters.regex('^Support$'), support),
+                MessageHandler(Filters.regex(ABOUT_RE), about),
+                MessageHandler(Filters.regex(PRODUCTS_RE), list_categories),
+                MessageHandler(Filters.regex(CART_RE), view_cart),
+                MessageHandler(Filters.regex(CHECKOUT_RE), checkout_start),
+                MessageHandler(Filters.regex(HISTORY_RE), order_history),
+                MessageHandler(Filters.regex(SUPPORT_RE), support),
             ],
-            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr)],
+            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr, run_async=True)],
             CHECKOUT_NOTES: [MessageHandler(Filters.text & ~Filters.command, checkout_notes)],
-            CHECKOUT_PAYTYPE: [MessageHandler(Filters.text & ~Filters.command, checkout_paytype)],
+            CHECKOUT_PAYTYPE: [MessageHandler(Filters.text & ~Filters.command, checkout_paytype, run_async=True)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True
@@ -784,22 +1012,27 @@ def main():
     dp.add_handler(conv)
 
     # Inline callbacks
-    dp.add_handler(CallbackQueryHandler(category_callback, pattern='^cat\|'))
-    dp.add_handler(CallbackQueryHandler(backcats_callback, pattern='^backcats$'))
-    dp.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern='^add\|'))
-    dp.add_handler(CallbackQueryHandler(menu_callback, pattern='^menu\|'))
-    dp.add_handler(CallbackQueryHandler(applycoupon_callback, pattern='^applycoupon$'))
-    dp.add_handler(CallbackQueryHandler(wish_callback, pattern='^wish\|'))
-    dp.add_handler(CallbackQueryHandler(send_public_key_callback, pattern='^getpub$'))
-    dp.add_handler(CallbackQueryHandler(rate_callback, pattern='^rate\|'))
+    dp.add_handler(CallbackQueryHandler(category_callback, pattern=CAT_RE))
+    dp.add_handler(CallbackQueryHandler(backcats_callback, pattern=BACKCATS_RE))
+    dp.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern=ADD_RE))
+    dp.add_handler(CallbackQueryHandler(menu_callback, pattern=MENU_RE))
+    dp.add_handler(CallbackQueryHandler(applycoupon_callback, pattern=APPLYCOUPON_RE))
+    dp.add_handler(CallbackQueryHandler(wish_callback, pattern=WISH_RE))
+    dp.add_handler(CallbackQueryHandler(send_public_key_callback, pattern=GETPUB_RE, run_async=True))
+    dp.add_handler(CallbackQueryHandler(rate_callback, pattern=RATE_RE))
 
     # Commands
-    dp.add_handler(MessageHandler(Filters.regex('^/track'), track_order))
-    dp.add_handler(MessageHandler(Filters.regex('^/download_address'), download_address))
+    dp.add_handler(CommandHandler('track', track_order))
+    dp.add_handler(CommandHandler('download_address', download_address, run_async=True))
 
-    updater.start_polling()
+    if WEBHOOK_URL:
+        updater.start_webhook(listen='0.0.0.0', port=WEBHOOK_PORT, url_path=TOKEN,
+                              webhook_url='{}/{}'.format(WEBHOOK_URL.rstrip('/'), TOKEN))
+    else:
+        updater.start_polling()
     print('Bot started')
     updater.idle()
+    flush_data()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,22 @@
+import atexit
+import io
+import itertools
 import json
 import logging
+import math
 import os
+import queue
+import threading
 import time
-from functools import wraps
-from uuid import uuid4
+from functools import lru_cache, wraps
+from operator import itemgetter
 from dotenv import load_dotenv
 import gnupg
+try:
+    from orjson import OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_NON_STR_KEYS, dumps as _orjson_dumps, loads as _loads
+except ImportError:  # optional speedup, fall back to the stdlib parser
+    _orjson_dumps = None
+    _loads = json.loads
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler, CallbackContext)
 
@@ -25,80 +36,235 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 # Initialize GPG - use the correct API for python-gnupg 0.5.6
+# The bot only ever uses its own key, so skip the web-of-trust bookkeeping
+# gpg would otherwise redo on every call. python-gnupg already runs gpg
+# with --batch and --no-tty.
+GPG_OPTIONS = ['--no-auto-check-trustdb', '--trust-model', 'always']
 try:
-    gpg = gnupg.GPG(gnupghome=GNUPG_HOME)
+    gpg = gnupg.GPG(gnupghome=GNUPG_HOME, options=GPG_OPTIONS)
 except TypeError:
     # Fallback for older API
     gpg = gnupg.GPG()
     gpg.gnupghome = GNUPG_HOME
+    gpg.options = GPG_OPTIONS
 
 # Conversation states
-ASK_SECRET, ASK_COUNTRY, MAIN_MENU, CHECKOUT_ADDR, CHECKOUT_NOTES, CHECKOUT_PAYTYPE = range(6)
+ASK_SECRET, ASK_COUNTRY, MAIN_MENU, CHECKOUT_ADDR, CHECKOUT_NOTES, CHECKOUT_PAYTYPE, INLINE_ADDR, INLINE_NOTES = range(8)
+
+# Keyboards that never change, built once at import
+MAIN_MENU_BUTTON = InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')
+CHECKOUT_BUTTON = InlineKeyboardButton('🧾 Checkout', callback_data='inlinecheckout|start')
+BACK_TO_CATEGORIES_ROW = [InlineKeyboardButton('Back to categories', callback_data='backcats')]
+BACK_TO_MAIN_MARKUP = InlineKeyboardMarkup([[MAIN_MENU_BUTTON]])
+START_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton('🛍️ Listings', callback_data='menu|products'), InlineKeyboardButton('🎟️ 10% Coupon', callback_data='menu|coupon')],
+    [InlineKeyboardButton('🛰️ Track', callback_data='menu|track'), InlineKeyboardButton('ℹ️ About', callback_data='menu|about')],
+    [InlineKeyboardButton('⭐ Ratings', callback_data='menu|ratings'), InlineKeyboardButton('🔐 PGP', callback_data='menu|pgp')],
+    [InlineKeyboardButton('💖 Wishlist', callback_data='menu|wishlist'), InlineKeyboardButton('🛒 Cart', callback_data='menu|cart')],
+    [InlineKeyboardButton('📞 Contact', callback_data='menu|contact'), InlineKeyboardButton('➕ Others', callback_data='menu|others')],
+])
+COUPON_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton('✅ Apply Coupon', callback_data='applycoupon')], [MAIN_MENU_BUTTON]])
+CART_MARKUP = InlineKeyboardMarkup([[CHECKOUT_BUTTON], [MAIN_MENU_BUTTON]])
+PGP_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton('📄 Get Public Key', callback_data='getpub')], [MAIN_MENU_BUTTON]])
+RATINGS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton('⭐' * i, callback_data=f'rate|{i}') for i in range(1, 6)],
+    [MAIN_MENU_BUTTON],
+])
+OTHERS_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton('🧾 Order History', callback_data='menu|history')], [MAIN_MENU_BUTTON]])
+PAY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton('Pay BTC', callback_data='pay|BTC')],
+    [InlineKeyboardButton('Pay USDT', callback_data='pay|USDT')],
+    [MAIN_MENU_BUTTON],
+])
+MAIN_MENU_MARKUP = ReplyKeyboardMarkup([
+    ['About', 'Products'],
+    ['Cart', 'Checkout'],
+    ['Order History', 'Support']
+], resize_keyboard=True)
+COUNTRY_MARKUP = ReplyKeyboardMarkup([[c] for c in ('USA', 'UK', 'Nigeria', 'India', 'Other')], one_time_keyboard=True, resize_keyboard=True)
+PAYTYPE_MARKUP = ReplyKeyboardMarkup([['BTC', 'USDT']], one_time_keyboard=True, resize_keyboard=True)
 
 # Helper JSON functions
 
+# Parsed contents of DATA_FILE, keyed on the stat that produced them so
+# handlers only re-parse the file after it changes on disk.
+_CACHE = {'mtime': None, 'size': None, 'data': None}
+# Single writer for DATA_FILE. Re-parses take it too, so a re-parse of the
+# old file can never be remembered over data that was just written.
+_DATA_LOCK = threading.RLock()
+
+# Lookup tables derived from the cached data, rebuilt whenever it is re-parsed.
+_TID_INDEX = {}  # telegram_id -> secret
+_PID_INDEX = {}  # product id -> (category, product)
+_OID_INDEX = {}  # order id -> order
+_WISH_IDS = {}  # secret -> ids in that user's wishlist, filled on first add
+# Source of the suffix of new order ids, continuing after the highest one on file
+_ORDER_SEQ = itertools.count(1)
+# Bumped on every re-parse, since that is how catalog edits reach the bot
+_PRODUCTS_VERSION = 0
+
+
+def _next_order_seq(orders):
+    seq = 0
+    for o in orders:
+        try:
+            seq = max(seq, int(o['order_id'].rsplit('-', 1)[1], 16))
+        except (IndexError, ValueError):
+            pass
+    return seq + 1
+
+
+def _index(data):
+    global _ORDER_SEQ, _PRODUCTS_VERSION
+    _TID_INDEX.clear()
+    _TID_INDEX.update((u['telegram_id'], s) for s, u in data.get('users', {}).items() if u.get('telegram_id'))
+    _PID_INDEX.clear()
+    _PID_INDEX.update((p['id'], (cat, p)) for cat, items in data.get('products', {}).items() for p in items)
+    _OID_INDEX.clear()
+    _OID_INDEX.update((o['order_id'], o) for o in data.get('orders', []))
+    _WISH_IDS.clear()
+    _ORDER_SEQ = itertools.count(_next_order_seq(data.get('orders', [])))
+    _PRODUCTS_VERSION += 1
+
+
+def _remember(data, st):
+    _CACHE['mtime'] = st.st_mtime_ns
+    _CACHE['size'] = st.st_size
+    _CACHE['data'] = data
+
+
 def load_data():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    st = os.stat(DATA_FILE)
+    if (st.st_mtime_ns, st.st_size) == (_CACHE['mtime'], _CACHE['size']):
+        return _CACHE['data']
+    with _DATA_LOCK:
+        st = os.stat(DATA_FILE)
+        if (st.st_mtime_ns, st.st_size) == (_CACHE['mtime'], _CACHE['size']):
+            return _CACHE['data']
+        with open(DATA_FILE, 'rb') as f:
+            data = _loads(f.read())
+        _index(data)
+        _remember(data, st)
+        return data
 
 
 def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
+    with _DATA_LOCK:
+        # Write to a temp file and swap it in so a crash never leaves a torn data.json
+        if _orjson_dumps is not None:
+            # NON_STR_KEYS turns non-string keys into strings, as json.dumps does
+            raw = _orjson_dumps(data, option=OPT_INDENT_2 | OPT_NON_STR_KEYS | OPT_APPEND_NEWLINE)
+        else:
+            raw = (json.dumps(data, indent=2) + '\n').encode('utf-8')
+        tmp = DATA_FILE + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, DATA_FILE)
+        _remember(data, os.stat(DATA_FILE))
+
+
+# Snapshots waiting for the background writer. The cache is already the
+# live data, so handlers that can tolerate a short delay hand their writes
+# off here instead of blocking on disk.
+_WRITE_Q = queue.Queue()
+# The writer waits this long after the first queued save, so a burst of
+# clicks costs a single write.
+SAVE_DELAY = 0.5
+
+
+def save_data_later(data):
+    """Queue data to be written by the background writer."""
+    _WRITE_Q.put(data)
+
+
+def _writer_loop():
+    while True:
+        data = _WRITE_Q.get()
+        pending = 1
+        time.sleep(SAVE_DELAY)
+        # Only the newest snapshot needs writing; older ones are superseded
+        try:
+            while True:
+                data = _WRITE_Q.get_nowait()
+                pending += 1
+        except queue.Empty:
+            pass
+        try:
+            save_data(data)
+        except Exception:
+            logger.exception('Background save of %s failed', DATA_FILE)
+        finally:
+            for _ in range(pending):
+                _WRITE_Q.task_done()
+
+
+# Let the writer finish queued saves before the process exits
+atexit.register(_WRITE_Q.join)
 
 
 # PGP helper functions
+
+# Fingerprint of the bot's key in the local keyring, resolved on first use
+_BOT_KEY_FP = None
+_KEYGEN_LOCK = threading.Lock()
+
+
 def generate_pgp_keys():
     """Generate a PGP key pair if not exists."""
-    data = load_data()
-    pgp_config = data.get('pgp_config', {})
+    # Checkouts running side by side on a fresh install must not generate two keys
+    with _KEYGEN_LOCK:
+        data = load_data()
+        pgp_config = data.get('pgp_config', {})
 
-    if pgp_config.get('key_generated'):
-        return pgp_config.get('public_key')
+        if pgp_config.get('key_generated'):
+            return pgp_config.get('public_key')
 
-    # Generate new key
-    input_data = gpg.gen_key_input(
-        key_type='RSA',
-        key_length=2048,
-        name_email='bot@ecommerce.local',
-        name_real='Ecommerce Bot'
-    )
-    key = gpg.gen_key(input_data)
-    key_id = str(key)
+        # Generate new key
+        input_data = gpg.gen_key_input(
+            key_type='RSA',
+            key_length=2048,
+            name_email='bot@ecommerce.local',
+            name_real='Ecommerce Bot'
+        )
+        key = gpg.gen_key(input_data)
+        key_id = str(key)
 
-    # Export public key
-    public_key = gpg.export_keys(key_id)
+        # Export public key
+        public_key = gpg.export_keys(key_id)
 
-    # Save to data.json (ensure pgp_config exists)
-    data.setdefault('pgp_config', {})
-    data['pgp_config']['key_generated'] = True
-    data['pgp_config']['public_key'] = public_key
-    data['pgp_config']['key_id'] = key_id
-    save_data(data)
+        # Save to data.json (ensure pgp_config exists)
+        data.setdefault('pgp_config', {})
+        data['pgp_config']['key_generated'] = True
+        data['pgp_config']['public_key'] = public_key
+        data['pgp_config']['key_id'] = key_id
+        save_data(data)
 
-    return public_key
+        return public_key
 
 
 def encrypt_address(address):
-    """Encrypt delivery address with the bot's public key."""
-    data = load_data()
-    public_key = data.get('pgp_config', {}).get('public_key')
+    """Encrypt delivery address with the bot's public key.
 
-    if not public_key:
-        # Generate keys if not exists
+    Raises RuntimeError if gpg fails, rather than returning an empty address.
+    """
+    global _BOT_KEY_FP
+    if _BOT_KEY_FP is None:
         public_key = generate_pgp_keys()
-
-    # Import public key
-    import_result = gpg.import_keys(public_key)
-    key_id = import_result.fingerprints[0] if import_result.fingerprints else None
-
-    if not key_id:
-        # Fallback: try to get from existing keys
-        data = load_data()
-        key_id = data.get('pgp_config', {}).get('key_id')
+        # Import once per process: data.json may name a key this keyring has
+        # never seen (fresh deploy, restored data file)
+        import_result = gpg.import_keys(public_key)
+        if import_result.fingerprints:
+            _BOT_KEY_FP = import_result.fingerprints[0]
+        else:
+            _BOT_KEY_FP = load_data().get('pgp_config', {}).get('key_id')
 
     # Encrypt
-    encrypted_data = gpg.encrypt(address, key_id, always_trust=True)
+    encrypted_data = gpg.encrypt(address, _BOT_KEY_FP, always_trust=True)
+    if not encrypted_data.ok:
+        logger.error('Address encryption failed: %s', encrypted_data.status)
+        raise RuntimeError('address encryption failed')
     return str(encrypted_data)
 
 
@@ -112,15 +278,10 @@ def decrypt_address(encrypted_address):
 def ensure_user(func):
     @wraps(func)
     def wrapped(update: Update, context: CallbackContext, *args, **kwargs):
-        user = update.effective_user
-        data = load_data()
-        # try to find user by telegram id
-        found = None
-        for secret, u in data.get('users', {}).items():
-            if u.get('telegram_id') == user.id:
-                found = secret
-                break
-        if not found:
+        load_data()  # refreshes _TID_INDEX if data.json changed on disk
+        try:
+            found = _TID_INDEX[update.effective_user.id]
+        except KeyError:
             # Not registered
             update.message.reply_text("You need to /start and register with a secret phrase first.")
             return ConversationHandler.END
@@ -133,12 +294,7 @@ def ensure_user(func):
 def start(update: Update, context: CallbackContext):
      # If user already registered, show the start menu; otherwise begin registration
     user = update.effective_user
-    data = load_data()
-    found = None
-    for secret, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user.id:
-            found = secret
-            break
+    found = find_secret_by_user_id(user.id)
     if found:
         context.user_data['secret'] = found
         return send_start_menu(update, context)
@@ -157,21 +313,19 @@ def ask_country(update: Update, context: CallbackContext):
     if secret in users:
         update.message.reply_text("This secret phrase is already registered. Welcome back!")
     else:
-        users[secret] = {
+        # Kept in the session until a country is chosen; save_country stores it
+        context.user_data['pending_user'] = {
             'username': update.effective_user.username or '',
             'telegram_id': update.effective_user.id,
             'country': None,
             'cart': [],
+            'cart_total': 0.0,
             'orders': []
         }
-        save_data(data)
         update.message.reply_text("Secret saved!")
 
-    # country selection keyboard
-    countries = ['USA', 'UK', 'Nigeria', 'India', 'Other']
-    keyboard = ReplyKeyboardMarkup([[c] for c in countries], one_time_keyboard=True, resize_keyboard=True)
     context.user_data['pending_secret'] = secret
-    update.message.reply_text('Please choose your country:', reply_markup=keyboard)
+    update.message.reply_text('Please choose your country:', reply_markup=COUNTRY_MARKUP)
     return ASK_COUNTRY
 
 
@@ -184,12 +338,18 @@ def save_country(update: Update, context: CallbackContext):
     data = load_data()
     users = data.setdefault('users', {})
     user = users.get(secret)
+    pending = context.user_data.pop('pending_user', None)
+    if not user and pending:
+        user = users[secret] = pending
     if not user:
         update.message.reply_text('User not found. Please /start again.', reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
     user['country'] = country
     user['username'] = update.effective_user.username or user.get('username', '')
+    if user.get('telegram_id') != update.effective_user.id:
+        _TID_INDEX.pop(user.get('telegram_id'), None)
     user['telegram_id'] = update.effective_user.id
+    _TID_INDEX[user['telegram_id']] = secret
     save_data(data)
     context.user_data['secret'] = secret
 
@@ -199,16 +359,11 @@ def save_country(update: Update, context: CallbackContext):
 
 # Main menu
 def show_main_menu(update: Update, context: CallbackContext):
-    keyboard = [
-        ['About', 'Products'],
-        ['Cart', 'Checkout'],
-        ['Order History', 'Support']
-    ]
     if update.callback_query:
         update.callback_query.answer()
-        update.callback_query.edit_message_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        update.callback_query.edit_message_text('Main Menu:', reply_markup=MAIN_MENU_MARKUP)
     else:
-        update.message.reply_text('Main Menu:', reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+        update.message.reply_text('Main Menu:', reply_markup=MAIN_MENU_MARKUP)
     return MAIN_MENU
 
 
@@ -224,19 +379,30 @@ def support(update: Update, context: CallbackContext):
     return MAIN_MENU
 
 
+@lru_cache(maxsize=1)
+def _categories_markup(version):
+    """Category picker keyboard; None if there are no categories.
+
+    ``version`` is _PRODUCTS_VERSION, so a changed catalog misses the cache.
+    """
+    cats = list(_CACHE['data'].get('products', {}).keys())
+    if not cats:
+        return None
+    buttons = [[InlineKeyboardButton(c, callback_data='cat|{}'.format(c))] for c in cats]
+    buttons.append([MAIN_MENU_BUTTON])
+    return InlineKeyboardMarkup(buttons)
+
+
 @ensure_user
 def list_categories(update: Update, context: CallbackContext):
-    data = load_data()
-    cats = list(data.get('products', {}).keys())
-    if not cats:
+    load_data()  # bumps _PRODUCTS_VERSION if data.json changed on disk
+    markup = _categories_markup(_PRODUCTS_VERSION)
+    if not markup:
         if getattr(update, 'callback_query', None):
             update.callback_query.edit_message_text('No product categories available.')
         else:
             update.message.reply_text('No product categories available.')
         return MAIN_MENU
-    buttons = [[InlineKeyboardButton(c, callback_data='cat|{}'.format(c))] for c in cats]
-    buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
-    markup = InlineKeyboardMarkup(buttons)
     if getattr(update, 'callback_query', None):
         update.callback_query.edit_message_text('Product categories:', reply_markup=markup)
     else:
@@ -244,22 +410,19 @@ def list_categories(update: Update, context: CallbackContext):
     return MAIN_MENU
 
 
-def category_callback(update: Update, context: CallbackContext):
-    query = update.callback_query
-    query.answer()
-    _, cat = query.data.split('|', 1)
-    data = load_data()
-    products = data.get('products', {}).get(cat, [])
+@lru_cache(maxsize=64)
+def _render_category_static(cat, version):
+    """Text and product button rows of a category; None if it has no products.
+
+    ``version`` is _PRODUCTS_VERSION, so a changed catalog misses the cache.
+    """
+    products = _CACHE['data'].get('products', {}).get(cat, [])
     if not products:
-        query.edit_message_text('No products in this category.')
-        return
-    text = "Products in {}:\n".format(cat)
-    buttons = []
+        return None
+    parts = [f"Products in {cat}:\n"]
+    rows = []
     for p in products:
         name = p['name']
-        price = p['price']
-        desc = p['description']
-        pid = p['id']
         qty_text = ""
         if 'quantities' in p:
             q = p['quantities']
@@ -267,25 +430,44 @@ def category_callback(update: Update, context: CallbackContext):
                 qty_text = "Available: " + ", ".join([f"{k} ({v})" for k, v in q.items()])
             elif isinstance(q, list):
                 qty_text = "Available: " + ", ".join(map(str, q))
-        text += f"\n{name} — ${price}\n{desc}\n{qty_text}\n"
-        buttons.append([
-            InlineKeyboardButton("Add {}".format(name), callback_data='add|{}'.format(pid)),
-            InlineKeyboardButton("❤️ Wishlist", callback_data='wish|{}'.format(pid))
-        ])
-    # Add cart total and checkout controls
-    user_id = update.effective_user.id if update.effective_user else None
+        parts.append(f"\n{name} — ${p['price']}\n{p['description']}\n{qty_text}\n")
+        rows.append((
+            InlineKeyboardButton(f"Add {name}", callback_data=f"add|{p['id']}"),
+            InlineKeyboardButton("❤️ Wishlist", callback_data=f"wish|{p['id']}")
+        ))
+    return ''.join(parts), tuple(rows)
+
+
+def _render_category(data, cat, secret):
+    """Return (text, markup) for a category view, or None if it is empty."""
+    static = _render_category_static(cat, _PRODUCTS_VERSION)
+    if static is None:
+        return None
+    text, rows = static
     total = 0.0
-    if user_id:
-        secret = find_secret_by_user_id(user_id)
-        if secret:
-            user = data.get('users', {}).get(secret, {})
-            total = sum(item['price'] for item in user.get('cart', []))
+    if secret:
+        total = cart_total(data.get('users', {}).get(secret, {}))
+    buttons = list(rows)
     buttons.append([
         InlineKeyboardButton(f'🛒 Cart: ${total:.2f}', callback_data='menu|cart'),
-        InlineKeyboardButton('🧾 Checkout', callback_data='inlinecheckout|start')
+        CHECKOUT_BUTTON
     ])
-    buttons.append([InlineKeyboardButton('Back to categories', callback_data='backcats')])
-    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    buttons.append(BACK_TO_CATEGORIES_ROW)
+    return text, InlineKeyboardMarkup(buttons)
+
+
+def category_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    cat = query.data[4:]  # after 'cat|'
+    data = load_data()
+    secret = find_secret_by_user_id(update.effective_user.id) if update.effective_user else None
+    view = _render_category(data, cat, secret)
+    if not view:
+        query.edit_message_text('No products in this category.')
+        return
+    text, markup = view
+    query.edit_message_text(text, reply_markup=markup)
 
 
 def backcats_callback(update: Update, context: CallbackContext):
@@ -296,75 +478,33 @@ def backcats_callback(update: Update, context: CallbackContext):
 
 def add_to_cart_callback(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
-    _, pid = query.data.split('|', 1)
+    pid = query.data[4:]  # after 'add|'
     data = load_data()
-    product = None
-    current_cat = None
-    for cat, items in data.get('products', {}).items():
-        for p in items:
-            if p['id'] == pid:
-                product = p
-                current_cat = cat
-                break
-        if product:
-            break
+    current_cat, product = _PID_INDEX.get(pid, (None, None))
     if not product:
+        query.answer()
         query.edit_message_text('Product not found.')
         return
     # find user by telegram id
-    user = update.effective_user
-    secret = None
-    for s, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user.id:
-            secret = s
-            break
+    secret = _TID_INDEX.get(update.effective_user.id)
     if not secret:
+        query.answer()
         query.edit_message_text('User not registered. Use /start to register.')
         return
-    users = data['users']
-    cart = users[secret].setdefault('cart', [])
-    cart.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
-    save_data(data)
+    user = data['users'][secret]
+    # Checkouts on the worker pool take the cart under this lock; keep the
+    # item and the running total in step with them
+    with _DATA_LOCK:
+        user['cart_total'] = cart_total(user) + product['price']
+        user.setdefault('cart', []).append({'id': product['id'], 'name': product['name'], 'price': product['price']})
+    save_data_later(data)
     query.answer("Added {} to cart.".format(product['name']), show_alert=True)
 
     # Re-render the category view with updated cart total and checkout option
-    if current_cat:
-        products = data.get('products', {}).get(current_cat, [])
-        view_text = f"Products in {current_cat}:\n"
-        view_buttons = []
-        for prod in products:
-            name = prod['name']
-            price = prod['price']
-            desc = prod['description']
-            pid2 = prod['id']
-            qty_text = ""
-            if 'quantities' in prod:
-                q = prod['quantities']
-                if isinstance(q, dict):
-                    qty_text = "Available: " + ", ".join([f"{k} ({v})" for k, v in q.items()])
-                elif isinstance(q, list):
-                    qty_text = "Available: " + ", ".join(map(str, q))
-            view_text += f"\n{name} — ${price}\n{desc}\n{qty_text}\n"
-            view_buttons.append([
-                InlineKeyboardButton(f"Add {name}", callback_data=f"add|{pid2}"),
-                InlineKeyboardButton("❤️ Wishlist", callback_data=f"wish|{pid2}")
-            ])
-        # Compute total for this user
-        total_value = 0.0
-        secret_user = None
-        for s, u in data.get('users', {}).items():
-            if u.get('telegram_id') == update.effective_user.id:
-                secret_user = s
-                break
-        if secret_user:
-            total_value = sum(item['price'] for item in data['users'][secret_user].get('cart', []))
-        view_buttons.append([
-            InlineKeyboardButton(f"🛒 Cart: ${total_value:.2f}", callback_data='menu|cart'),
-            InlineKeyboardButton('🧾 Checkout', callback_data='inlinecheckout|start')
-        ])
-        view_buttons.append([InlineKeyboardButton('Back to categories', callback_data='backcats')])
-        query.edit_message_text(view_text, reply_markup=InlineKeyboardMarkup(view_buttons))
+    view = _render_category(data, current_cat, secret)
+    if view:
+        text, markup = view
+        query.edit_message_text(text, reply_markup=markup)
 
 
 @ensure_user
@@ -376,13 +516,11 @@ def view_cart(update: Update, context: CallbackContext):
     if not cart:
         update.message.reply_text('Your cart is empty.')
         return MAIN_MENU
-    text = 'Your cart:\n'
-    total = 0
+    parts = ['Your cart:\n']
     for idx, item in enumerate(cart, 1):
-        text += "{0}. {1} — ${2}\n".format(idx, item['name'], item['price'])
-        total += item['price']
-    text += "\nTotal: ${:.2f}".format(total)
-    update.message.reply_text(text)
+        parts.append("{0}. {1} — ${2}\n".format(idx, item['name'], item['price']))
+    parts.append("\nTotal: ${:.2f}".format(cart_total(user)))
+    update.message.reply_text(''.join(parts))
     return MAIN_MENU
 
 
@@ -402,7 +540,11 @@ def checkout_start(update: Update, context: CallbackContext):
 def checkout_addr(update: Update, context: CallbackContext):
     addr = update.message.text.strip()
     # Encrypt address
-    encrypted_addr = encrypt_address(addr)
+    try:
+        encrypted_addr = encrypt_address(addr)
+    except RuntimeError:
+        update.message.reply_text('Could not encrypt your address right now. Please try again later or /cancel.')
+        return CHECKOUT_ADDR
     context.user_data['addr'] = encrypted_addr
     context.user_data['addr_plain'] = addr  # Store plain for reference
     update.message.reply_text('Address saved (encrypted). Any delivery notes? (or send "skip")')
@@ -415,8 +557,7 @@ def checkout_notes(update: Update, context: CallbackContext):
         context.user_data['notes'] = ''
     else:
         context.user_data['notes'] = notes
-    keyboard = ReplyKeyboardMarkup([['BTC', 'USDT']], one_time_keyboard=True, resize_keyboard=True)
-    update.message.reply_text('Choose payment type:', reply_markup=keyboard)
+    update.message.reply_text('Choose payment type:', reply_markup=PAYTYPE_MARKUP)
     return CHECKOUT_PAYTYPE
 
 
@@ -434,18 +575,20 @@ def checkout_paytype(update: Update, context: CallbackContext):
         update.message.reply_text('Your cart is empty. Aborting.')
         return MAIN_MENU
 
-    # Calculate totals and apply coupon if available
-    subtotal = sum(item['price'] for item in cart)
+    # Charge exactly the items that go on the order; clicks may still be
+    # adding to the live cart while this handler runs
+    items = list(cart)
+    subtotal = math.fsum(map(_price, items))
     discount = 0.0
     if user.get('coupon') == 'SAVE10':
         discount = round(subtotal * 0.10, 2)
     total_amount = round(subtotal - discount, 2)
 
-    order_id = str(int(time.time())) + '-' + uuid4().hex[:6]
+    order_id = f"{int(time.time())}-{next(_ORDER_SEQ):06x}"
     order = {
         'order_id': order_id,
         'user': secret,
-        'items': cart.copy(),
+        'items': items,
         'address_encrypted': context.user_data.get('addr'),
         'notes': context.user_data.get('notes', ''),
         'payment_type': pay,
@@ -456,13 +599,22 @@ def checkout_paytype(update: Update, context: CallbackContext):
         'total': total_amount,
         'coupon': user.get('coupon') if discount > 0 else ''
     }
-    data.setdefault('orders', []).append(order)
-    user.setdefault('orders', []).append(order_id)
-    user['cart'] = []
-    # Clear coupon after use
-    if 'coupon' in user:
-        user.pop('coupon', None)
-    save_data(data)
+    # Handlers run concurrently on the worker pool; keep the order insert and its write together
+    with _DATA_LOCK:
+        if user.get('cart') is not cart:
+            update.message.reply_text('This cart was already checked out.')
+            return MAIN_MENU
+        data.setdefault('orders', []).append(order)
+        _OID_INDEX[order_id] = order
+        user.setdefault('orders', []).append(order_id)
+        # Items added after the snapshot stay in the cart for the next order
+        rest = cart[len(items):]
+        user['cart'] = rest
+        user['cart_total'] = math.fsum(map(_price, rest))
+        # Clear coupon after use
+        if 'coupon' in user:
+            user.pop('coupon', None)
+        save_data(data)
 
     payinfo = data.get('payment', {})
     addrinfo = payinfo.get('btc_address') if pay == 'BTC' else payinfo.get('usdt_address')
@@ -480,10 +632,22 @@ def checkout_paytype(update: Update, context: CallbackContext):
     return send_start_menu(update, context)
 
 
+_price = itemgetter('price')
+
+
+def cart_total(user):
+    """Running total of the user's cart, kept up to date by add_to_cart_callback."""
+    total = user.get('cart_total')
+    if total is None:  # carts filled before the total was tracked
+        total = math.fsum(map(_price, user.get('cart', [])))
+    return total
+
+
 def order_total(order):
-    subtotal = sum(item['price'] for item in order['items'])
-    discount = order.get('discount', 0) or 0
-    return subtotal - discount
+    total = order.get('total')
+    if total is None:  # orders placed before the total was stored
+        total = math.fsum(map(_price, order['items'])) - (order.get('discount', 0) or 0)
+    return total
 
 
 @ensure_user
@@ -493,11 +657,11 @@ def track_order(update: Update, context: CallbackContext):
         update.message.reply_text('Usage: /track ORDER_ID')
         return
     oid = args[1]
-    data = load_data()
-    for o in data.get('orders', []):
-        if o['order_id'] == oid:
-            update.message.reply_text("Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
-            return
+    load_data()  # refreshes _OID_INDEX if data.json changed on disk
+    o = _OID_INDEX.get(oid)
+    if o and o.get('user') == context.user_data.get('secret'):
+        update.message.reply_text("Order {}: status {}. Items: {} Total: ${:.2f}".format(oid, o['status'], len(o['items']), order_total(o)))
+        return
     update.message.reply_text('Order not found.')
 
 
@@ -511,16 +675,10 @@ def download_address(update: Update, context: CallbackContext):
 
     oid = args[1]
     secret = context.user_data.get('secret')
-    data = load_data()
-
-    # Find order
-    order = None
-    for o in data.get('orders', []):
-        if o['order_id'] == oid and o.get('user') == secret:
-            order = o
-            break
+    load_data()  # refreshes _OID_INDEX if data.json changed on disk
 
-    if not order:
+    order = _OID_INDEX.get(oid)
+    if not order or order.get('user') != secret:
         update.message.reply_text('Order not found or you do not have permission to access it.')
         return
 
@@ -529,22 +687,10 @@ def download_address(update: Update, context: CallbackContext):
         update.message.reply_text('No encrypted address found for this order.')
         return
 
-    # Create temporary file
+    # Send file straight from memory
     filename = "{}_address.asc".format(oid)
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(encrypted_addr)
-
-    # Send file
-    with open(filepath, 'rb') as f:
-        update.message.reply_document(f, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
-
-    # Clean up
-    try:
-        os.remove(filepath)
-    except:
-        pass
+    document = io.BytesIO(encrypted_addr.encode('utf-8'))
+    update.message.reply_document(document, filename=filename, caption="Encrypted delivery address for order {}".format(oid))
 
 
 @ensure_user
@@ -555,13 +701,13 @@ def order_history(update: Update, context: CallbackContext):
     if not orders:
         update.message.reply_text('No orders yet.')
         return MAIN_MENU
-    text = 'Your orders:\n'
+    parts = ['Your orders:\n']
     for o in orders:
         oid = o['order_id']
         status = o['status']
         total = order_total(o)
-        text += "{} — {} — ${:.2f}\n".format(oid, status, total)
-    update.message.reply_text(text)
+        parts.append("{} — {} — ${:.2f}\n".format(oid, status, total))
+    update.message.reply_text(''.join(parts))
     return MAIN_MENU
 
 
@@ -573,11 +719,8 @@ def cancel(update: Update, context: CallbackContext):
 # Helper: find user secret by telegram id
 
 def find_secret_by_user_id(user_id):
-    data = load_data()
-    for s, u in data.get('users', {}).items():
-        if u.get('telegram_id') == user_id:
-            return s
-    return None
+    load_data()  # refreshes _TID_INDEX if data.json changed on disk
+    return _TID_INDEX.get(user_id)
 
 
 # Start menu with inline buttons
@@ -588,14 +731,7 @@ def send_start_menu(update: Update, context: CallbackContext):
         "Browse listings, grab a 10% coupon 🎟️, track orders 🛰️, secure your address with PGP 🔐, and more.\n\n"
         "Choose an option:"
     )
-    keyboard = [
-        [InlineKeyboardButton('🛍️ Listings', callback_data='menu|products'), InlineKeyboardButton('🎟️ 10% Coupon', callback_data='menu|coupon')],
-        [InlineKeyboardButton('🛰️ Track', callback_data='menu|track'), InlineKeyboardButton('ℹ️ About', callback_data='menu|about')],
-        [InlineKeyboardButton('⭐ Ratings', callback_data='menu|ratings'), InlineKeyboardButton('🔐 PGP', callback_data='menu|pgp')],
-        [InlineKeyboardButton('💖 Wishlist', callback_data='menu|wishlist'), InlineKeyboardButton('🛒 Cart', callback_data='menu|cart')],
-        [InlineKeyboardButton('📞 Contact', callback_data='menu|contact'), InlineKeyboardButton('➕ Others', callback_data='menu|others')],
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
+    markup = START_MENU_MARKUP
     if getattr(update, 'callback_query', None):
         update.callback_query.answer()
         update.callback_query.edit_message_text(text, reply_markup=markup, disable_web_page_preview=True)
@@ -604,210 +740,155 @@ def send_start_menu(update: Update, context: CallbackContext):
     return MAIN_MENU
 
 
-def menu_callback(update: Update, context: CallbackContext):
-    query = update.callback_query
-    query.answer()
-
-    # Safe callback parsing
-    parts = query.data.split('|', 1)
-    choice = parts[1] if len(parts) > 1 else parts[0]
-
-    user = update.effective_user
-    user_id = user.id if user else None
-
-    data = load_data()
-    secret = find_secret_by_user_id(user_id)
-
-    # ---------------- PRODUCTS ----------------
-    if choice == 'products':
-        cats = list(data.get('products', {}).keys())
-
-        if not cats:
-            query.edit_message_text('No product categories available.')
-            return
-
-        buttons = [[InlineKeyboardButton(cat_name, callback_data=f'cat|{cat_name}')] for cat_name in cats]
-        buttons.append([InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')])
-
-        query.edit_message_text(
-            '🛍️ Product categories:',
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
-
-    # ---------------- COUPON ----------------
-    elif choice == 'coupon':
-        text = (
-            "🎟️ 10% OFF COUPON\n"
-            "Use code SAVE10.\n"
-            "Tap Apply Coupon to attach it to your next order."
-        )
-
-        buttons = [
-            [InlineKeyboardButton('✅ Apply Coupon', callback_data='applycoupon')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
-
-        query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ---------------- CART ----------------
-    elif choice == 'cart':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
-
-        user_data = data.get('users', {}).get(secret)
-        if not user_data:
-            query.edit_message_text('User not found. Please /start again.')
-            return
+# Inline main-menu sections, one function per menu|<choice> button
 
-        cart = user_data.get('cart', [])
-
-        if not cart:
-            txt = '🛒 Your cart is empty.'
-        else:
-            total = sum(item['price'] for item in cart)
-            lines = ['🛒 Your cart:']
-
-            for idx, item in enumerate(cart, 1):
-                lines.append(f"{idx}. {item['name']} — ${item['price']:.2f}")
-
-            if user_data.get('coupon') == 'SAVE10':
-                lines.append("\n🎟️ Coupon applied: -10% (applies at checkout)")
-
-            lines.append(f"\nSubtotal: ${total:.2f}")
-            txt = "\n".join(lines)
-
-        if not cart:
-            buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        else:
-            buttons = [
-                [InlineKeyboardButton('🧾 Checkout', callback_data='inlinecheckout|start')],
-                [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-            ]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ---------------- WISHLIST ----------------
-    elif choice == 'wishlist':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
+def _menu_products(query, data, secret):
+    markup = _categories_markup(_PRODUCTS_VERSION)
+    if not markup:
+        query.edit_message_text('No product categories available.')
+        return
+    query.edit_message_text('🛍️ Product categories:', reply_markup=markup)
 
-        user_data = data.get('users', {}).get(secret)
-        if not user_data:
-            query.edit_message_text('User not found. Please /start again.')
-            return
 
-        wishlist = user_data.get('wishlist', [])
+def _menu_coupon(query, data, secret):
+    text = (
+        "🎟️ 10% OFF COUPON\n"
+        "Use code SAVE10.\n"
+        "Tap Apply Coupon to attach it to your next order."
+    )
+    query.edit_message_text(text, reply_markup=COUPON_MARKUP)
 
-        if not wishlist:
-            txt = '💖 Your wishlist is empty.'
-        else:
-            lines = ['💖 Your wishlist:']
-            for idx, item in enumerate(wishlist, 1):
-                lines.append(f"{idx}. {item['name']} — ${item['price']:.2f}")
-            txt = "\n".join(lines)
-
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ---------------- PGP ----------------
-    elif choice == 'pgp':
-        txt = (
-            "🔐 PGP Address Encryption\n"
-            "Your delivery address is encrypted before storage.\n"
-            "You may also import the bot's public key."
-        )
 
-        buttons = [
-            [InlineKeyboardButton('📄 Get Public Key', callback_data='getpub')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
+def _menu_cart(query, data, secret):
+    if not secret:
+        query.edit_message_text('Please /start to register first.')
+        return
+    user_data = data.get('users', {}).get(secret)
+    if not user_data:
+        query.edit_message_text('User not found. Please /start again.')
+        return
+    cart = user_data.get('cart', [])
+    if not cart:
+        txt = '🛒 Your cart is empty.'
+    else:
+        total = cart_total(user_data)
+        lines = ['🛒 Your cart:']
+        for idx, item in enumerate(cart, 1):
+            lines.append(f"{idx}. {item['name']} — ${item['price']:.2f}")
+        if user_data.get('coupon') == 'SAVE10':
+            lines.append("\n🎟️ Coupon applied: -10% (applies at checkout)")
+        lines.append(f"\nSubtotal: ${total:.2f}")
+        txt = "\n".join(lines)
+    query.edit_message_text(txt, reply_markup=CART_MARKUP if cart else BACK_TO_MAIN_MARKUP)
+
+
+def _menu_wishlist(query, data, secret):
+    if not secret:
+        query.edit_message_text('Please /start to register first.')
+        return
+    user_data = data.get('users', {}).get(secret)
+    if not user_data:
+        query.edit_message_text('User not found. Please /start again.')
+        return
+    wishlist = user_data.get('wishlist', [])
+    if not wishlist:
+        txt = '💖 Your wishlist is empty.'
+    else:
+        lines = ['💖 Your wishlist:']
+        for idx, item in enumerate(wishlist, 1):
+            lines.append(f"{idx}. {item['name']} — ${item['price']:.2f}")
+        txt = "\n".join(lines)
+    query.edit_message_text(txt, reply_markup=BACK_TO_MAIN_MARKUP)
+
+
+def _menu_pgp(query, data, secret):
+    txt = (
+        "🔐 PGP Address Encryption\n"
+        "Your delivery address is encrypted before storage.\n"
+        "You may also import the bot's public key."
+    )
+    query.edit_message_text(txt, reply_markup=PGP_MARKUP)
 
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
 
-    # ---------------- ABOUT ----------------
-    elif choice == 'about':
-        txt = (
-            "ℹ️ About\n"
-            "This is a demo ecommerce bot.\n"
-            "Browse products, add to cart, and checkout securely with PGP."
-        )
+def _menu_about(query, data, secret):
+    txt = (
+        "ℹ️ About\n"
+        "This is a demo ecommerce bot.\n"
+        "Browse products, add to cart, and checkout securely with PGP."
+    )
+    query.edit_message_text(txt, reply_markup=BACK_TO_MAIN_MARKUP)
 
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
 
-    # ---------------- TRACK ----------------
-    elif choice == 'track':
-        txt = "🛰️ Track Orders\nSend the command:\n/track ORDER_ID"
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
+def _menu_track(query, data, secret):
+    txt = "🛰️ Track Orders\nSend the command:\n/track ORDER_ID"
+    query.edit_message_text(txt, reply_markup=BACK_TO_MAIN_MARKUP)
 
-    # ---------------- RATINGS ----------------
-    elif choice == 'ratings':
-        ratings = data.get('ratings', [])
 
-        if ratings:
-            avg = sum(r['value'] for r in ratings) / len(ratings)
-            stats = f"{len(ratings)} ratings, average {avg:.1f} ⭐"
-        else:
-            stats = "No ratings yet."
+def _menu_ratings(query, data, secret):
+    ratings = data.get('ratings', [])
+    if ratings:
+        avg = sum(r['value'] for r in ratings) / len(ratings)
+        stats = f"{len(ratings)} ratings, average {avg:.1f} ⭐"
+    else:
+        stats = "No ratings yet."
+    query.edit_message_text(f"⭐ Ratings\n{stats}\nTap to rate:", reply_markup=RATINGS_MARKUP)
 
-        buttons = [
-            [InlineKeyboardButton('⭐' * i, callback_data=f'rate|{i}') for i in range(1, 6)],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
 
-        query.edit_message_text(
-            f"⭐ Ratings\n{stats}\nTap to rate:",
-            reply_markup=InlineKeyboardMarkup(buttons)
-        )
+def _menu_contact(query, data, secret):
+    txt = (
+        "📞 Contact\n"
+        "Support: support@example.com\n"
+        "Reply here and an agent will reach out."
+    )
+    query.edit_message_text(txt, reply_markup=BACK_TO_MAIN_MARKUP)
 
-    # ---------------- CONTACT ----------------
-    elif choice == 'contact':
-        txt = (
-            "📞 Contact\n"
-            "Support: support@example.com\n"
-            "Reply here and an agent will reach out."
-        )
 
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ---------------- OTHERS ----------------
-    elif choice == 'others':
-        buttons = [
-            [InlineKeyboardButton('🧾 Order History', callback_data='menu|history')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ]
-        query.edit_message_text('➕ Others', reply_markup=InlineKeyboardMarkup(buttons))
-
-    # ---------------- ORDER HISTORY ----------------
-    elif choice == 'history':
-        if not secret:
-            query.edit_message_text('Please /start to register first.')
-            return
+def _menu_others(query, data, secret):
+    query.edit_message_text('➕ Others', reply_markup=OTHERS_MARKUP)
 
-        orders = [
-            o for o in data.get('orders', [])
-            if o.get('user') == secret
-        ]
 
-        if not orders:
-            txt = '🧾 No orders yet.'
-        else:
-            lines = ['🧾 Your orders:']
-            for o in orders:
-                lines.append(
-                    f"{o['order_id']} → {o['status']} — ${order_total(o):.2f}"
-                )
-            txt = "\n".join(lines)
+def _menu_history(query, data, secret):
+    if not secret:
+        query.edit_message_text('Please /start to register first.')
+        return
+    orders = [o for o in data.get('orders', []) if o.get('user') == secret]
+    if not orders:
+        txt = '🧾 No orders yet.'
+    else:
+        lines = ['🧾 Your orders:']
+        for o in orders:
+            lines.append(f"{o['order_id']} → {o['status']} — ${order_total(o):.2f}")
+        txt = "\n".join(lines)
+    query.edit_message_text(txt, reply_markup=BACK_TO_MAIN_MARKUP)
+
+
+MENU_SECTIONS = {
+    'products': _menu_products,
+    'coupon': _menu_coupon,
+    'cart': _menu_cart,
+    'wishlist': _menu_wishlist,
+    'pgp': _menu_pgp,
+    'about': _menu_about,
+    'track': _menu_track,
+    'ratings': _menu_ratings,
+    'contact': _menu_contact,
+    'others': _menu_others,
+    'history': _menu_history,
+}
 
-        buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-        query.edit_message_text(txt, reply_markup=InlineKeyboardMarkup(buttons))
 
-    # ---------------- MAIN MENU ----------------
-    elif choice == 'main':
-        send_start_menu(update, context)
+def menu_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    # Safe callback parsing
+    choice = query.data.partition('|')[2] or query.data
+    section = MENU_SECTIONS.get(choice)
+    if section is None:
+        # 'main' and anything unknown go back to the start menu, which answers the query itself
+        return send_start_menu(update, context)
+    query.answer()
+    user = update.effective_user
+    data = load_data()
+    section(query, data, find_secret_by_user_id(user.id) if user else None)
 
 
 # Apply coupon callback
@@ -822,48 +903,50 @@ def applycoupon_callback(update: Update, context: CallbackContext):
     data = load_data()
     user = data['users'].get(secret)
     user['coupon'] = 'SAVE10'
-    save_data(data)
-    buttons = [[InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]]
-    query.edit_message_text('✅ Coupon applied. You will get 10% off at checkout.', reply_markup=InlineKeyboardMarkup(buttons))
+    save_data_later(data)
+    query.edit_message_text('✅ Coupon applied. You will get 10% off at checkout.', reply_markup=BACK_TO_MAIN_MARKUP)
 
 
 # Wishlist add callback
 
 def wish_callback(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
     secret = find_secret_by_user_id(update.effective_user.id)
     if not secret:
+        query.answer()
         query.edit_message_text('Please /start to register first.')
         return
     data = load_data()
-    # Find product by id
-    _prefix, pid = query.data.split('|', 1)
-    product = None
-    for cat, items in data.get('products', {}).items():
-        for p in items:
-            if p['id'] == pid:
-                product = p
-                break
-        if product:
-            break
+    pid = query.data[5:]  # after 'wish|'
+    _cat, product = _PID_INDEX.get(pid, (None, None))
     if not product:
+        query.answer()
         query.edit_message_text('Product not found.')
         return
     user = data['users'][secret]
     wl = user.setdefault('wishlist', [])
+    ids = _WISH_IDS.get(secret)
+    if ids is None:
+        ids = _WISH_IDS[secret] = {w.get('id') for w in wl}
     # Avoid duplicates by id
-    if not any(w.get('id') == product['id'] for w in wl):
+    if product['id'] not in ids:
+        ids.add(product['id'])
         wl.append({'id': product['id'], 'name': product['name'], 'price': product['price']})
-        save_data(data)
+        save_data_later(data)
     query.answer('Added to wishlist ❤️', show_alert=True)
 
 
 # Send public key file
 
-def send_public_key_callback(update: Update, context: CallbackContext):
-    query = update.callback_query
-    query.answer()
+# The bot's armored public key, exported once and then reused for every request
+_PUB_KEY_BYTES = None
+
+
+def _public_key_bytes():
+    """Return the bot's public key as bytes, or None if it could not be exported."""
+    global _PUB_KEY_BYTES
+    if _PUB_KEY_BYTES is not None:
+        return _PUB_KEY_BYTES
     # Obtain/generate the public key robustly
     public_key = generate_pgp_keys() or ''
     if not public_key.strip():
@@ -890,28 +973,22 @@ def send_public_key_callback(update: Update, context: CallbackContext):
             except Exception:
                 public_key = ''
     if not public_key.strip():
+        return None
+    _PUB_KEY_BYTES = public_key.encode('utf-8')
+    return _PUB_KEY_BYTES
+
+
+def send_public_key_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    public_key = _public_key_bytes()
+    if not public_key:
         # Inform the user if GPG is not available/configured properly
         context.bot.send_message(update.effective_chat.id, 'PGP key generation/export failed. Ensure GnuPG (gpg) is installed on the server and accessible in PATH.')
         return
-    # Send as a file
-    filename = 'bot_public_key.asc'
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(public_key)
-        with open(filepath, 'rb') as f:
-            context.bot.send_document(update.effective_chat.id, f, filename=filename, caption='PGP Public Key')
-    finally:
-        try:
-            os.remove(filepath)
-        except Exception:
-            pass
-    # Also send as text (in case file viewers fail to open)
-    try:
-        if len(public_key) < 3800:
-            context.bot.send_message(update.effective_chat.id, 'PGP Public Key (copy/paste):\n' + public_key)
-    except Exception:
-        pass
+    document = io.BytesIO(public_key)
+    context.bot.send_document(update.effective_chat.id, document, filename='bot_public_key.asc',
+                              caption='PGP Public Key (plain text, open it with any text editor)')
 
 
 # Inline checkout flow
@@ -929,44 +1006,35 @@ def inlinecheckout_callback(update: Update, context: CallbackContext):
     if not cart:
         query.edit_message_text('🛒 Your cart is empty.')
         return
-    context.user_data['inline_checkout_state'] = 'awaiting_address'
     query.edit_message_text('📍 Please enter your delivery address:')
+    return INLINE_ADDR
 
 
-def inline_checkout_text_handler(update: Update, context: CallbackContext):
-    state = context.user_data.get('inline_checkout_state')
-    if not state:
-        return
-    if state == 'awaiting_address':
-        addr = update.message.text.strip()
-        enc = encrypt_address(addr)
-        context.user_data['addr'] = enc
-        context.user_data['notes'] = ''
-        context.user_data['inline_checkout_state'] = 'awaiting_notes'
-        update.message.reply_text('📝 Any delivery notes? (or type "skip")')
-        return
-    if state == 'awaiting_notes':
-        notes = update.message.text.strip()
-        if notes.lower() != 'skip':
-            context.user_data['notes'] = notes
-        context.user_data['inline_checkout_state'] = 'awaiting_payment'
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton('Pay BTC', callback_data='pay|BTC')],
-            [InlineKeyboardButton('Pay USDT', callback_data='pay|USDT')],
-            [InlineKeyboardButton('⬅️ Main Menu', callback_data='menu|main')]
-        ])
-        update.message.reply_text('Choose payment type:', reply_markup=kb)
-        return
+def inline_checkout_addr(update: Update, context: CallbackContext):
+    addr = update.message.text.strip()
+    try:
+        context.user_data['addr'] = encrypt_address(addr)
+    except RuntimeError:
+        update.message.reply_text('Could not encrypt your address right now. Please try again later or /cancel.')
+        return INLINE_ADDR
+    context.user_data['notes'] = ''
+    update.message.reply_text('📝 Any delivery notes? (or type "skip")')
+    return INLINE_NOTES
+
+
+def inline_checkout_notes(update: Update, context: CallbackContext):
+    notes = update.message.text.strip()
+    if notes.lower() != 'skip':
+        context.user_data['notes'] = notes
+    update.message.reply_text('Choose payment type:', reply_markup=PAY_MARKUP)
+    return MAIN_MENU
 
 
 def pay_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
-    try:
-        _, pay = query.data.split('|', 1)
-    except ValueError:
-        pay = 'BTC'
-    pay = pay.upper()
+    pay = query.data[4:].upper() or 'BTC'  # after 'pay|'
+    ud = context.user_data
 
     secret = find_secret_by_user_id(update.effective_user.id)
     data = load_data()
@@ -977,53 +1045,64 @@ def pay_callback(update: Update, context: CallbackContext):
     cart = user.get('cart', [])
     if not cart:
         query.edit_message_text('Your cart is empty. Aborting.')
-        context.user_data.pop('inline_checkout_state', None)
         return
 
-    subtotal = sum(item['price'] for item in cart)
+    # Charge exactly the items that go on the order; clicks may still be
+    # adding to the live cart while this handler runs
+    items = list(cart)
+    subtotal = math.fsum(map(_price, items))
+    coupon = user.get('coupon')
     discount = 0.0
-    if user.get('coupon') == 'SAVE10':
+    if coupon == 'SAVE10':
         discount = round(subtotal * 0.10, 2)
     total_amount = round(subtotal - discount, 2)
 
-    order_id = str(int(time.time())) + '-' + uuid4().hex[:6]
+    now = int(time.time())
+    order_id = f"{now}-{next(_ORDER_SEQ):06x}"
     order = {
         'order_id': order_id,
         'user': secret,
-        'items': cart.copy(),
-        'address_encrypted': context.user_data.get('addr'),
-        'notes': context.user_data.get('notes', ''),
+        'items': items,
+        'address_encrypted': ud.get('addr'),
+        'notes': ud.get('notes', ''),
         'payment_type': pay,
         'status': 'pending',
-        'timestamp': int(time.time()),
+        'timestamp': now,
         'subtotal': subtotal,
         'discount': discount,
         'total': total_amount,
-        'coupon': user.get('coupon') if discount > 0 else ''
+        'coupon': coupon if discount > 0 else ''
     }
-    data.setdefault('orders', []).append(order)
-    user.setdefault('orders', []).append(order_id)
-    user['cart'] = []
-    if 'coupon' in user:
+    # One atomic write covers the order and every user field it touches
+    with _DATA_LOCK:
+        if user.get('cart') is not cart:
+            query.edit_message_text('This cart was already checked out.')
+            return
+        data.setdefault('orders', []).append(order)
+        _OID_INDEX[order_id] = order
+        user.setdefault('orders', []).append(order_id)
+        # Items added after the snapshot stay in the cart for the next order
+        rest = cart[len(items):]
+        user['cart'] = rest
+        user['cart_total'] = math.fsum(map(_price, rest))
         user.pop('coupon', None)
-    save_data(data)
+        save_data(data)
 
     payinfo = data.get('payment', {})
     addrinfo = payinfo.get('btc_address') if pay == 'BTC' else payinfo.get('usdt_address')
-    msg_lines = [
-        f"Order {order_id} created!",
-        f"Total: {total_amount:.2f} {pay}",
-        f"Pay to: {addrinfo or 'N/A'}",
-    ]
-    if discount > 0:
-        msg_lines.append(f"(🎟️ 10% coupon applied: -${discount:.2f} | Subtotal: ${subtotal:.2f})")
-    msg_lines.append("")
-    msg_lines.append(f"Your address is encrypted. Send /download_address {order_id} to get your encrypted address file.")
-    msg_lines.append(f"Then send /track {order_id} to see status.")
-    query.edit_message_text("\n".join(msg_lines))
+    coupon_line = f"(🎟️ 10% coupon applied: -${discount:.2f} | Subtotal: ${subtotal:.2f})\n" if discount > 0 else ""
+    query.edit_message_text(
+        f"Order {order_id} created!\n"
+        f"Total: {total_amount:.2f} {pay}\n"
+        f"Pay to: {addrinfo or 'N/A'}\n"
+        f"{coupon_line}"
+        "\n"
+        f"Your address is encrypted. Send /download_address {order_id} to get your encrypted address file.\n"
+        f"Then send /track {order_id} to see status."
+    )
 
-    for k in ['inline_checkout_state', 'addr', 'notes']:
-        context.user_data.pop(k, None)
+    for k in ('addr', 'notes'):
+        ud.pop(k, None)
 
 
 # Rating submission
@@ -1031,7 +1110,7 @@ def pay_callback(update: Update, context: CallbackContext):
 def rate_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
-    _prefix, val = query.data.split('|', 1)
+    val = query.data[5:]  # after 'rate|'
     try:
         rating = int(val)
         if rating < 1 or rating > 5:
@@ -1043,17 +1122,52 @@ def rate_callback(update: Update, context: CallbackContext):
     data = load_data()
     entry = {'user': secret, 'value': rating, 'ts': int(time.time())}
     data.setdefault('ratings', []).append(entry)
-    save_data(data)
+    save_data_later(data)
     query.edit_message_text(f'Thanks for rating {"⭐" * rating}!')
 
 
+# Inline button handlers, keyed on the callback_data prefix before '|'
+CALLBACK_HANDLERS = {
+    'cat': category_callback,
+    'backcats': backcats_callback,
+    'add': add_to_cart_callback,
+    'menu': menu_callback,
+    'applycoupon': applycoupon_callback,
+    'wish': wish_callback,
+    'getpub': send_public_key_callback,
+    'rate': rate_callback,
+    'pay': pay_callback,
+}
+# Prefixes whose handlers wait on gpg or a synchronous save; they run on the worker pool
+ASYNC_CALLBACKS = frozenset(('getpub', 'pay'))
+
+
+def callback_router(update: Update, context: CallbackContext):
+    query = update.callback_query
+    prefix = query.data.partition('|')[0]
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        query.answer()
+        return
+    if prefix in ASYNC_CALLBACKS:
+        context.dispatcher.run_async(handler, update, context, update=update)
+        return
+    return handler(update, context)
+
+
 def main():
-    updater = Updater(TOKEN, use_context=True)
+    threading.Thread(target=_writer_loop, name='data-writer', daemon=True).start()
+    # Handlers spend most of their time waiting on Telegram, so size the pool well past the core count
+    updater = Updater(TOKEN, use_context=True, workers=(os.cpu_count() or 1) * 4)
     dp = updater.dispatcher
 
     # Main conversation handler
     conv = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[
+            CommandHandler('start', start),
+            # The inline Checkout button can start a checkout from any state
+            CallbackQueryHandler(inlinecheckout_callback, pattern='^inlinecheckout\\|'),
+        ],
         states={
             ASK_SECRET: [MessageHandler(Filters.text & ~Filters.command, ask_country)],
             ASK_COUNTRY: [MessageHandler(Filters.text & ~Filters.command, save_country)],
@@ -1065,9 +1179,11 @@ def main():
                 MessageHandler(Filters.regex('^Order History'), order_history),
                 MessageHandler(Filters.regex('^Support'), support),
             ],
-            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr)],
+            CHECKOUT_ADDR: [MessageHandler(Filters.text & ~Filters.command, checkout_addr, run_async=True)],
             CHECKOUT_NOTES: [MessageHandler(Filters.text & ~Filters.command, checkout_notes)],
-            CHECKOUT_PAYTYPE: [MessageHandler(Filters.text & ~Filters.command, checkout_paytype)],
+            CHECKOUT_PAYTYPE: [MessageHandler(Filters.text & ~Filters.command, checkout_paytype, run_async=True)],
+            INLINE_ADDR: [MessageHandler(Filters.text & ~Filters.command, inline_checkout_addr, run_async=True)],
+            INLINE_NOTES: [MessageHandler(Filters.text & ~Filters.command, inline_checkout_notes)],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
         allow_reentry=True
@@ -1076,23 +1192,11 @@ def main():
     dp.add_handler(conv)
 
     # Inline callbacks
-    dp.add_handler(CallbackQueryHandler(category_callback, pattern='^cat\\|'))
-    dp.add_handler(CallbackQueryHandler(backcats_callback, pattern='^backcats$'))
-    dp.add_handler(CallbackQueryHandler(add_to_cart_callback, pattern='^add\\|'))
-    dp.add_handler(CallbackQueryHandler(menu_callback, pattern='^menu\\|'))
-    dp.add_handler(CallbackQueryHandler(applycoupon_callback, pattern='^applycoupon$'))
-    dp.add_handler(CallbackQueryHandler(wish_callback, pattern='^wish\\|'))
-    dp.add_handler(CallbackQueryHandler(send_public_key_callback, pattern='^getpub$'))
-    dp.add_handler(CallbackQueryHandler(rate_callback, pattern='^rate\\|'))
-    dp.add_handler(CallbackQueryHandler(inlinecheckout_callback, pattern='^inlinecheckout\\|'))
-    dp.add_handler(CallbackQueryHandler(pay_callback, pattern='^pay\\|'))
-
-    # Inline checkout text handler (address, notes)
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, inline_checkout_text_handler))
+    dp.add_handler(CallbackQueryHandler(callback_router))
 
     # Commands
     dp.add_handler(MessageHandler(Filters.regex('^/track'), track_order))
-    dp.add_handler(MessageHandler(Filters.regex('^/download_address'), download_address))
+    dp.add_handler(MessageHandler(Filters.regex('^/download_address'), download_address, run_async=True))
 
     updater.start_polling()
     print('Bot started')